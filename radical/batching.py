@@ -0,0 +1,60 @@
+import asyncio
+from typing import Callable, Awaitable, Any, NoReturn
+
+from radical.log import logger
+
+
+class MethodBatcher(object):
+    # Collects concurrent calls to a single method and invokes it once with
+    # stacked arguments: f(1, b=2) and f(3, b=4) become f([1, 3], b=[2, 4]),
+    # which must return one result per call, in order.
+    # Calls are grouped by number of positional arguments & keyword names.
+
+    def __init__(self, method: str, call: Callable[..., Awaitable], batch_size: int, max_wait: float, loop):
+        # `call(args, kwargs)` invokes the method with stacked arguments.
+        self.method = method
+        self.call = call
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.loop = loop
+        self.pending = {}
+        self.timers = {}
+
+    async def submit(self, args, kwargs) -> Any:
+        key = (len(args), tuple(sorted(kwargs)))
+        future = self.loop.create_future()
+        group = self.pending.setdefault(key, [])
+        group.append((args, kwargs, future))
+        if len(group) >= self.batch_size:
+            self._flush(key)
+        elif len(group) == 1:
+            self.timers[key] = self.loop.call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key) -> NoReturn:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        # Calls cancelled while waiting for the batch are left out.
+        group = [item for item in self.pending.pop(key, ()) if not item[2].done()]
+        if group:
+            asyncio.ensure_future(self._run(group), loop=self.loop)
+
+    async def _run(self, group) -> NoReturn:
+        args = [[item_args[index] for item_args, _, _ in group] for index in range(len(group[0][0]))]
+        kwargs = {name: [item_kwargs[name] for _, item_kwargs, _ in group] for name in group[0][1]}
+        logger.debug(f'Calling {self.method} with a batch of {len(group)}')
+        try:
+            results = list(await self.call(args, kwargs))
+            if len(results) != len(group):
+                raise ValueError(
+                    f'{self.method} returned {len(results)} results for a batch of {len(group)} calls.'
+                )
+        except Exception as error:
+            for _, _, future in group:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, _, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import traceback
+import contextlib
+from time import perf_counter, process_time
+
+from radical.client import Client
+from radical.worker import Worker
+from radical.transports.base import BaseTransport
+from radical.serialization import create_serializer
+from radical.serialization.base import RadicalRequest, RadicalResponse, Signature
+from radical.serialization.pickle import PickleSerializer
+
+SERIALIZERS = (
+    'radical.serialization.pickle:PickleSerializer',
+    'radical.serialization.json:JSONSerializer',
+    'radical.serialization.msgpack:MsgPackSerializer',
+)
+
+PASSTHROUGH = 'radical.serialization.passthrough:PassthroughSerializer'
+
+TRANSPORTS = dict(
+    memory=('radical.transports.memory:MemoryTransport', 'memory://bench'),
+    redis=('radical.transports.redis:RedisTransport', 'redis://127.0.0.1:6379/0'),
+    postgres=('radical.transports.postgres:PostgresTransport', 'postgres://postgres@127.0.0.1:5432/postgres'),
+)
+
+METHODS = ('sync', 'async', 'slow')
+
+PAYLOADS = dict(
+    small=lambda: ((1300, 37), {}),
+    text=lambda: (('x' * 65536,), {}),
+    records=lambda: (([dict(id=i, name=f'item {i}', score=i / 3) for i in range(1000)],), {}),
+    binary=lambda: ((os.urandom(1 << 20),), {}),
+)
+
+
+class StubTransport(BaseTransport):
+    # Serves a fixed number of pre-encoded requests without any I/O.
+
+    def __init__(self, transport_url, queue_name, loop):
+        super().__init__(transport_url, queue_name, loop)
+        self.requests = []
+        self.replies = 0
+        self.expected = 0
+        self.finished = None
+
+    def feed(self, requests):
+        self.requests = list(reversed(requests))
+        self.replies = 0
+        self.expected = len(requests)
+        self.finished = asyncio.Event()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def get_next_requests(self, count=1):
+        if self.requests:
+            batch = self.requests[-count:]
+            del self.requests[-count:]
+            return batch[::-1]
+        await asyncio.sleep(0.01)
+        return []
+
+    def new_request_id(self):
+        return 'bench'
+
+    async def reply_to(self, request_id, message):
+        self.replies += 1
+        if self.replies == self.expected:
+            self.finished.set()
+
+
+def _create_worker(loop, **kwargs):
+    worker = Worker(
+        'stub://', 'bench',
+        transport='radical.bench:StubTransport',
+        loop=loop,
+        **kwargs
+    )
+
+    async def wait(delay, result=42):
+        return await asyncio.sleep(delay, result=result)
+
+    worker.register_method('bench.wait', wait)
+    return worker
+
+
+async def bench_scheduler(loop, in_flight, delay, rounds):
+    # Keeps exactly `in_flight` slow methods running at once: with an O(1)
+    # scheduler the overhead per request must not depend on `in_flight`.
+    worker = _create_worker(loop, concurrency=in_flight)
+    serializer = PickleSerializer()
+    request = serializer.encode_request(RadicalRequest(
+        signature=Signature(method='bench.wait', args=(delay,), kwargs={}),
+        reply_to='bench'
+    ))
+    total = in_flight * rounds
+    worker.transport.feed([request] * total)
+    with contextlib.redirect_stderr(open(os.devnull, 'w')):
+        await worker.start()
+    started = perf_counter()
+    await worker.transport.finished.wait()
+    elapsed = perf_counter() - started
+    await worker.stop()
+    return dict(
+        in_flight=in_flight,
+        requests=total,
+        elapsed=elapsed,
+        rps=total / elapsed,
+        overhead_us=max(elapsed - rounds * delay, 0) / total * 1e6,
+    )
+
+
+def bench_serializer(serializer_path, payload, iterations):
+    # Full round trip: encode & decode both request and response.
+    try:
+        serializer = create_serializer(serializer_path)
+    except ImportError as error:
+        return dict(serializer=serializer_path, payload=payload, error=str(error))
+    args, kwargs = PAYLOADS[payload]()
+    request = RadicalRequest(
+        signature=Signature(method='bench.echo', args=args, kwargs=kwargs),
+        reply_to='bench'
+    )
+    response = RadicalResponse(request=request, result=args[0], error=None)
+    try:
+        started = perf_counter()
+        for _ in range(iterations):
+            request_data = serializer.encode_request(request)
+            serializer.decode_request(request_data)
+            response_data = serializer.encode_response(response)
+            serializer.decode_response(response_data)
+        elapsed = perf_counter() - started
+    except Exception as error:
+        return dict(serializer=serializer_path, payload=payload, error=repr(error))
+    return dict(
+        serializer=serializer_path,
+        payload=payload,
+        iterations=iterations,
+        roundtrip_us=elapsed / iterations * 1e6,
+        request_bytes=len(request_data),
+        response_bytes=len(response_data),
+    )
+
+
+def _percentile(values, percent):
+    # `values` must be sorted.
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+async def bench_e2e(loop, transport, url, serializer, method, payload, concurrency, requests, delay):
+    # Drives a real Client against a Worker in the same process & loop, so CPU
+    # time per request includes both sides (and the broker client libraries).
+    queue_name = f'radical-bench-{os.getpid()}'
+    url = url + ('&' if '?' in url else '?') + 'request_timeout=30'
+    result = dict(transport=transport, serializer=serializer, method=method, payload=payload, concurrency=concurrency)
+    transport_path = TRANSPORTS[transport][0]
+    try:
+        worker = Worker(
+            url, queue_name, transport=transport_path, serializer=serializer,
+            loop=loop, concurrency=max(concurrency, 1), executor='loop'
+        )
+        client = Client(url, queue_name, transport=transport_path, serializer=serializer, loop=loop)
+    except ImportError as error:
+        return dict(result, skipped=str(error))
+
+    def echo(value, *args):
+        return value
+
+    async def aecho(value, *args):
+        return value
+
+    async def slow(value, *args):
+        return await asyncio.sleep(delay, result=value)
+
+    worker.register_method('bench.sync', echo)
+    worker.register_method('bench.async', aecho)
+    worker.register_method('bench.slow', slow)
+    try:
+        with contextlib.redirect_stderr(open(os.devnull, 'w')):
+            await asyncio.wait_for(worker.start(), 5)
+        await asyncio.wait_for(client.start(), 5)
+    except Exception as error:
+        # Broker is not available here: report & carry on with the other combinations.
+        return dict(result, skipped=repr(error))
+    args, _ = PAYLOADS[payload]()
+    latencies = []
+    remaining = [requests]
+
+    async def run():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = perf_counter()
+            await client.call_wait(queue_name, f'bench.{method}', *args)
+            latencies.append(perf_counter() - started)
+
+    try:
+        # Warm up connections, code paths & caches.
+        await client.call_wait(queue_name, f'bench.{method}', *args)
+        cpu_started = process_time()
+        started = perf_counter()
+        await asyncio.gather(*[run() for _ in range(concurrency)])
+        elapsed = perf_counter() - started
+        cpu = process_time() - cpu_started
+    except Exception as error:
+        return dict(result, error=repr(error))
+    finally:
+        await client.stop()
+        await worker.stop()
+    latencies.sort()
+    return dict(
+        result,
+        requests=requests,
+        elapsed=elapsed,
+        rps=requests / elapsed,
+        p50_ms=_percentile(latencies, 50) * 1e3,
+        p95_ms=_percentile(latencies, 95) * 1e3,
+        p99_ms=_percentile(latencies, 99) * 1e3,
+        cpu_us_per_request=cpu / requests * 1e6,
+    )
+
+
+def _run_in_child(function, *args) -> dict:
+    # Runs `function(loop, *args)` in a forked process so that its peak RSS is
+    # not inflated by the combinations run before it.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        code = 0
+        try:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            result = loop.run_until_complete(function(loop, *args))
+            with os.fdopen(write_fd, 'w') as output:
+                json.dump(result, output)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as source:
+        data = source.read()
+    _, status, usage = os.wait4(pid, 0)
+    if not data:
+        return dict(error=f'Benchmark process failed with status {status}.')
+    result = json.loads(data)
+    if 'rps' in result:
+        # Peak of this combination's process (including what it inherited), in KiB on Linux.
+        result['peak_rss_kb'] = usage.ru_maxrss
+    return result
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Radical benchmarks.')
+    subparsers = parser.add_subparsers(dest='suite')
+    scheduler = subparsers.add_parser('scheduler', help='Worker scheduling overhead.')
+    scheduler.add_argument('--in-flight', default='10,100,1000,10000')
+    scheduler.add_argument('--delay', default=0.1, type=float)
+    scheduler.add_argument('--rounds', default=5, type=int)
+    serializers = subparsers.add_parser('serializers', help='Serializer round trip time & size.')
+    serializers.add_argument('--serializer', action='append', help='Defaults to all built-in serializers.')
+    serializers.add_argument('--payload', action='append', choices=sorted(PAYLOADS))
+    serializers.add_argument('--iterations', default=200, type=int)
+    e2e = subparsers.add_parser('e2e', help='Client to worker throughput, latency, CPU & memory.')
+    e2e.add_argument('--transport', action='append', choices=sorted(TRANSPORTS), help='Defaults to all transports.')
+    e2e.add_argument('--serializer', action='append', help='Defaults to all built-in serializers.')
+    e2e.add_argument('--method', action='append', choices=METHODS)
+    e2e.add_argument('--payload', action='append', choices=sorted(PAYLOADS), help='Defaults to "small".')
+    e2e.add_argument('--concurrency', default='1,10,100')
+    e2e.add_argument('--requests', default=2000, type=int)
+    e2e.add_argument('--delay', default=0.01, type=float, help='Duration of the "slow" method.')
+    for name, (_, url) in sorted(TRANSPORTS.items()):
+        e2e.add_argument(f'--{name}-url', default=url)
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    results = []
+    if args.suite == 'scheduler':
+        for in_flight in map(int, args.in_flight.split(',')):
+            results.append(loop.run_until_complete(
+                bench_scheduler(loop, in_flight, args.delay, args.rounds)
+            ))
+    elif args.suite == 'serializers':
+        for serializer_path in args.serializer or SERIALIZERS:
+            for payload in args.payload or sorted(PAYLOADS):
+                results.append(bench_serializer(serializer_path, payload, args.iterations))
+    elif args.suite == 'e2e':
+        for transport in args.transport or sorted(TRANSPORTS):
+            url = getattr(args, f'{transport}_url')
+            # Passthrough serializer only works in-process.
+            default_serializers = SERIALIZERS + ((PASSTHROUGH,) if transport == 'memory' else ())
+            for serializer_path in args.serializer or default_serializers:
+                for method in args.method or METHODS:
+                    for payload in args.payload or ['small']:
+                        for concurrency in map(int, args.concurrency.split(',')):
+                            results.append(_run_in_child(
+                                bench_e2e, transport, url, serializer_path, method, payload,
+                                concurrency, args.requests, args.delay
+                            ))
+    else:
+        parser.print_help()
+        sys.exit(1)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
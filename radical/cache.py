@@ -0,0 +1,120 @@
+import time
+import pickle
+import hashlib
+from collections import OrderedDict
+from typing import Tuple, Any
+
+
+def _order(value):
+    # Sort key that works for mixed types, e.g. {1: 'a', 'b': 2}.
+    return type(value).__name__, repr(value)
+
+
+def _canonical(value):
+    # JSON turns tuples into lists and dict order is arbitrary, so both are
+    # normalized to make equal calls produce equal keys.
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted(
+            ((key, _canonical(item)) for key, item in value.items()), key=lambda pair: _order(pair[0])
+        ))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted((_canonical(item) for item in value), key=_order))
+    return value
+
+
+def make_key(method: str, args, kwargs) -> str:
+    canonical = (method, _canonical(args), _canonical(kwargs or {}))
+    return hashlib.sha1(repr(canonical).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key) -> Tuple[bool, Any]:
+        item = self.data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires is None or expires > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self.data[key]
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self.data[key] = (expires, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+
+class MethodCache(object):
+    # Memoizes results of a single method in a local LRU and, optionally, in a
+    # tier shared by all workers through the transport.
+
+    def __init__(self, method: str, transport, ttl: float = None, maxsize: int = 1024, shared: bool = False):
+        self.method = method
+        self.transport = transport
+        self.ttl = ttl
+        self.shared = shared
+        self.local = LRUCache(maxsize, ttl)
+        self.shared_hits = 0
+
+    async def get(self, args, kwargs) -> Tuple[bool, Any]:
+        key = make_key(self.method, args, kwargs)
+        found, value = self.local.get(key)
+        if found or not self.shared:
+            return found, value
+        data = await self.transport.cache_get(self.method, key)
+        if data is None:
+            return False, None
+        self.shared_hits += 1
+        # Shared tier is only used by workers of the same pool running the same code.
+        value = pickle.loads(data)
+        self.local.set(key, value)
+        return True, value
+
+    async def set(self, args, kwargs, value):
+        key = make_key(self.method, args, kwargs)
+        self.local.set(key, value)
+        if self.shared:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            await self.transport.cache_set(self.method, key, data, self.ttl)
+
+    async def invalidate(self, args=None, kwargs=None):
+        key = None if args is None and kwargs is None else make_key(self.method, args or (), kwargs)
+        self.invalidate_local(key)
+        if self.shared:
+            await self.transport.cache_invalidate(self.method, key)
+
+    def invalidate_local(self, key: str = None):
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.delete(key)
+
+    def stats(self) -> dict:
+        return dict(
+            size=len(self.local.data),
+            hits=self.local.hits,
+            misses=self.local.misses,
+            evictions=self.local.evictions,
+            shared_hits=self.shared_hits,
+        )
@@ -1,10 +1,15 @@
+import time
 import asyncio
-import uuid
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List
 
+from radical import context, metrics
+from radical.hooks import START, END
 from radical.peer import Peer
-from radical.serialization.base import RadicalRequest, Signature
+from radical.cache import make_key
+from radical.serialization.base import RadicalRequest, RadicalResponse, Signature
 from radical.log import logger
-from radical.exceptions import RadicalException
+from radical.exceptions import RadicalException, TimeoutException
 
 
 class Client(Peer):
@@ -14,37 +19,207 @@ class Client(Peer):
             queue_name: str = None,
             transport: str = None,
             serializer: str = None,
-            loop=None
+            loop=None,
+            coalesce: bool = False
     ):
         super().__init__(
             transport_url, queue_name, transport, serializer, loop
         )
+        # When enabled, identical concurrent call_wait()s share one request.
+        self.coalesce = coalesce
+        self._in_flight = {}
 
-    async def call(self, queue_name, method, *args, **kwargs):
+    async def call(self, queue_name, method, *args, eta=None, countdown=None, **kwargs):
+        # `eta` (datetime or unix time) or `countdown` (seconds) delays the call,
+        # so these names cannot be passed to the method itself.
         logger.debug('Calling %s from %s (nowait mode)', method, queue_name)
-        radical_request = RadicalRequest(signature=Signature(
+        radical_request = self._make_request(Signature(
             method=method,
             args=args,
             kwargs=kwargs
         ), reply_to=None)
-        data = self.serializer.encode_request(radical_request)
-        await self.transport.send_to(queue_name, data)
+        if isinstance(eta, datetime):
+            eta = eta.timestamp()
+        if countdown is not None:
+            eta = time.time() + countdown
+        if eta is not None and eta > time.time():
+            logger.debug('Scheduling %s from %s at %s', method, queue_name, eta)
+            await self.transport.send_at(
+                queue_name, self._serialize('encode_request', radical_request), eta
+            )
+            return
+        await self._send(queue_name, radical_request)
 
     async def call_wait(self, queue_name, method, *args, **kwargs):
+        if not self.coalesce:
+            return await self._call_wait(queue_name, method, args, kwargs)
+        key = (queue_name, make_key(method, args, kwargs))
+        future = self._in_flight.get(key)
+        if future is None:
+            logger.debug('Calling %s from %s (coalesced)', method, queue_name)
+            future = asyncio.ensure_future(self._call_wait(queue_name, method, args, kwargs), loop=self.loop)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            logger.debug('Joining in-flight call to %s from %s', method, queue_name)
+        # Shielded: one caller being cancelled must not cancel the others.
+        # Note that all callers receive the same result object.
+        return await asyncio.shield(future)
+
+    async def _call_wait(self, queue_name, method, args, kwargs):
         logger.debug('Calling %s from %s (wait mode)', method, queue_name)
-        message_id = uuid.uuid1().hex
-        response_coroutine = await self.transport.get_response(message_id)
-        response_future = asyncio.ensure_future(response_coroutine, loop=self.loop)
-        radical_request = RadicalRequest(signature=Signature(
+        started = time.perf_counter()
+        try:
+            message_id = self.transport.new_request_id()
+            response_coroutine = await self.transport.get_response(message_id)
+            response_future = asyncio.ensure_future(response_coroutine, loop=self.loop)
+            radical_request = self._make_request(Signature(
+                method=method,
+                args=args,
+                kwargs=kwargs
+            ), reply_to=message_id, deadline=self._deadline())
+            await self._send(queue_name, radical_request)
+            self._fire('wait_response', START, radical_request)
+            try:
+                response = await response_future
+            except (asyncio.CancelledError, TimeoutException):
+                # Caller gave up: let the worker stop running (or drop) the request.
+                response_future.cancel()
+                self._cancel(queue_name, message_id)
+                raise
+            self._fire('wait_response', END, radical_request)
+            return self._unpack_response(self._decode_response(response, radical_request))
+        except Exception:
+            metrics.CLIENT_ERRORS.inc(method)
+            raise
+        finally:
+            metrics.CLIENT_REPLY.observe(time.perf_counter() - started, method)
+
+    async def call_stream(self, queue_name, method, *args, **kwargs) -> AsyncIterator:
+        # Yields items produced by a generator method as they arrive.
+        logger.debug('Calling %s from %s (stream mode)', method, queue_name)
+        message_id = self.transport.new_request_id()
+        messages = await self.transport.get_response_stream(message_id)
+        radical_request = self._make_request(Signature(
             method=method,
             args=args,
             kwargs=kwargs
-        ), reply_to=message_id)
-        data = self.serializer.encode_request(radical_request)
+        ), reply_to=message_id, stream=True)
+        await self._send(queue_name, radical_request)
+        # Chunks may arrive out of order: hold them until their turn comes.
+        pending, expected, finished = {}, 0, False
+        try:
+            async for response in messages:
+                radical_response = self._decode_response(response, radical_request)
+                finished = finished or radical_response.final
+                if radical_response.sequence is None:
+                    # Method did not return a generator.
+                    yield self._unpack_response(radical_response)
+                    return
+                pending[radical_response.sequence] = radical_response
+                while expected in pending:
+                    radical_response = pending.pop(expected)
+                    expected += 1
+                    if radical_response.final:
+                        self._unpack_response(radical_response)
+                        return
+                    yield radical_response.result
+        finally:
+            await messages.aclose()
+            if not finished:
+                # Consumer stopped early or failed: the generator on the worker is not needed anymore.
+                self._cancel(queue_name, message_id)
+
+    async def call_many(self, queue_name, calls: Iterable[tuple]):
+        # Each call is a (method, args) or (method, args, kwargs) tuple.
+        signatures = [self._make_signature(call) for call in calls]
+        logger.debug('Calling %d methods from %s (nowait mode)', len(signatures), queue_name)
+        await self.transport.send_many(queue_name, [
+            self._serialize('encode_request', self._make_request(signature, reply_to=None))
+            for signature in signatures
+        ])
+
+    async def call_wait_many(self, queue_name, calls: Iterable[tuple], return_exceptions=False) -> List:
+        signatures = [self._make_signature(call) for call in calls]
+        logger.debug('Calling %d methods from %s (wait mode)', len(signatures), queue_name)
+        data, response_futures = [], []
+        for signature in signatures:
+            message_id = self.transport.new_request_id()
+            response_coroutine = await self.transport.get_response(message_id)
+            response_futures.append(asyncio.ensure_future(response_coroutine, loop=self.loop))
+            data.append(self._serialize(
+                'encode_request', self._make_request(signature, reply_to=message_id, deadline=self._deadline())
+            ))
+        await self.transport.send_many(queue_name, data)
+        results = []
+        responses = await asyncio.gather(*response_futures, return_exceptions=True)
+        for signature, response in zip(signatures, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                results.append(self._unpack_response(self._serialize('decode_response', response)))
+            except Exception as error:
+                metrics.CLIENT_ERRORS.inc(signature.method)
+                if not return_exceptions:
+                    raise
+                results.append(error)
+        return results
+
+    async def invalidate_cache(self, queue_name, method, args=None, kwargs=None):
+        # Drops cached results of `method` for the given arguments, or all of them if none are given.
+        await self.call_wait(queue_name, '_cache_invalidate', method, args, kwargs)
+        # Shared tier is cleared first, so that other workers can't refill their local caches from it.
+        key = None if args is None and kwargs is None else make_key(method, args or (), kwargs)
+        await self.transport.send_control(queue_name, f'invalidate {method} {key}' if key else f'invalidate {method}')
+
+    def _make_request(self, signature: Signature, reply_to, **headers) -> RadicalRequest:
+        metrics.CLIENT_CALLS.inc(signature.method)
+        # Wall clock, so that workers on other hosts can compute queue wait time.
+        headers['sent_at'] = time.time()
+        # Calls made while handling a request continue its trace.
+        headers['trace'] = context.new_span(context.get('trace'))
+        return RadicalRequest(signature=signature, reply_to=reply_to, headers=headers)
+
+    def _cancel(self, queue_name, message_id):
+        # Not awaited, so that it is sent even though the calling task is being cancelled.
+        asyncio.ensure_future(self._send_cancel(queue_name, message_id), loop=self.loop)
+
+    async def _send_cancel(self, queue_name, message_id):
+        logger.debug('Cancelling %s from %s', message_id, queue_name)
+        try:
+            await self.transport.send_control(queue_name, f'cancel {message_id}')
+        except Exception as error:
+            logger.error(f'Failed to cancel {message_id}: {error!r}')
+
+    def _deadline(self) -> float:
+        # Wall clock time after which nobody waits for the response anymore: workers
+        # drop requests that are dequeued later. Calls made while handling a request
+        # never outlive its own deadline.
+        deadline = time.time() + self.transport.request_timeout
+        inherited = context.get('deadline')
+        if inherited is not None:
+            deadline = min(deadline, inherited)
+        return deadline
+
+    async def _send(self, queue_name, radical_request: RadicalRequest):
+        self._fire('encode_request', START, radical_request)
+        data = self._serialize('encode_request', radical_request)
+        self._fire('encode_request', END, radical_request)
+        self._fire('send_to', START, radical_request)
         await self.transport.send_to(queue_name, data)
-        response = await response_future
-        # TODO: Add timeout
-        radical_response = self.serializer.decode_response(response)
+        self._fire('send_to', END, radical_request)
+
+    def _decode_response(self, response, radical_request: RadicalRequest) -> RadicalResponse:
+        self._fire('decode_response', START, radical_request)
+        radical_response = self._serialize('decode_response', response)
+        self._fire('decode_response', END, radical_request)
+        return radical_response
+
+    def _make_signature(self, call: tuple) -> Signature:
+        method, args, kwargs = (tuple(call) + ({},))[:3]
+        return Signature(method=method, args=tuple(args), kwargs=kwargs)
+
+    def _unpack_response(self, radical_response: RadicalResponse):
         if radical_response.error:
             raise RadicalException(radical_response.error)
         return radical_response.result
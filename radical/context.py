@@ -0,0 +1,81 @@
+import time
+import uuid
+import asyncio
+import weakref
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    contextvars = None
+
+
+# Values of the request being handled: methods (and calls they make through
+# Client) can read them without extra arguments. With contextvars (3.7+)
+# they are inherited by tasks the method spawns, e.g. with asyncio.gather().
+if contextvars is not None:
+    _context = contextvars.ContextVar('radical_context', default={})
+
+    def get(key: str, default=None):
+        return _context.get().get(key, default)
+
+    def set(key: str, value):
+        # Copied rather than updated: a spawned task must not change its parent's values.
+        _context.set(dict(_context.get(), **{key: value}))
+
+    def inherit(loop):
+        # Tasks created in a context already copy it.
+        pass
+else:  # pragma: no cover
+    # Python 3.6: values are bound to the current task, and copied to the
+    # tasks it spawns on loops set up with `inherit()`.
+    current_task = asyncio.Task.current_task
+    _contexts = weakref.WeakKeyDictionary()
+
+    def _current_context(create=False) -> dict:
+        try:
+            task = current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return {}
+        if create:
+            return _contexts.setdefault(task, {})
+        return _contexts.get(task, {})
+
+    def get(key: str, default=None):
+        return _current_context().get(key, default)
+
+    def set(key: str, value):
+        _current_context(create=True)[key] = value
+
+    def inherit(loop):
+        # Custom task factories are left alone.
+        if loop.get_task_factory() is None:
+            loop.set_task_factory(_create_task)
+
+    def _create_task(loop, coro):
+        task = asyncio.Task(coro, loop=loop)
+        values = _current_context()
+        if values:
+            _contexts[task] = dict(values)
+        return task
+
+
+def remaining():
+    # Seconds left until the caller gives up waiting for the current request,
+    # None if it has no deadline.
+    deadline = get('deadline')
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+def new_span(parent: dict = None) -> dict:
+    # Trace context sent in request headers: a span shares `trace_id` with
+    # its parent and links to it with `parent_id`.
+    parent = parent or {}
+    return dict(
+        trace_id=parent.get('trace_id') or uuid.uuid4().hex,
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent.get('span_id'),
+    )
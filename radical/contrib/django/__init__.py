@@ -1 +1 @@
-from radical.contrib.django.client import call, call_wait
+from radical.contrib.django.client import call, call_wait, call_async, call_wait_async, get_session
@@ -1,43 +1,106 @@
+import os
+import atexit
 import asyncio
+import threading
+from concurrent.futures import Future
 
 from django.conf import settings
 
 from radical.client import Client
 
 
-def _create_session():
-    loop = asyncio.new_event_loop()
-    client = Client(
-        settings.RADICAL_CONFIG['TRANSPORT_URL'],
-        queue_name=settings.RADICAL_CONFIG.get('QUEUE_NAME'),
-        transport=settings.RADICAL_CONFIG.get('TRANSPORT'),
-        serializer=settings.RADICAL_CONFIG.get('SERIALIZER'),
-        loop=loop
-    )
-    return loop, client
+class Session(object):
+    # Long-lived client running its own event loop in a background thread.
+    # Shared by all threads of the process.
 
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.client = Client(
+            settings.RADICAL_CONFIG['TRANSPORT_URL'],
+            queue_name=settings.RADICAL_CONFIG.get('QUEUE_NAME'),
+            transport=settings.RADICAL_CONFIG.get('TRANSPORT'),
+            serializer=settings.RADICAL_CONFIG.get('SERIALIZER'),
+            loop=self.loop,
+            coalesce=settings.RADICAL_CONFIG.get('COALESCE', False)
+        )
+        self.thread = threading.Thread(target=self._run, name='radical-session', daemon=True)
+        self.thread.start()
+        try:
+            self.submit(self.client.start()).result()
+        except BaseException:
+            # Don't leave a loop thread behind for every failed attempt.
+            self._stop_loop()
+            raise
 
-def _destroy_session(client):
-    client.loop.run_until_complete(client.stop())
-    client.loop.stop()
-    client.loop.close()
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def close(self):
+        try:
+            self.submit(self.client.stop()).result()
+        finally:
+            self._stop_loop()
+
+    def _stop_loop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The loop thread does not survive fork, so the child must build its own
+    # session (and connections) instead of reusing the parent's.
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_session() -> Session:
+    global _session
+    session = _session
+    if session is None or session.pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session.pid != os.getpid():
+                _session = Session()
+            session = _session
+    return session
+
+
+@atexit.register
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None and _session.pid == os.getpid():
+            _session.close()
+        _session = None
+
+
+def call_async(queue_name, method, *args, **kwargs) -> Future:
+    session = get_session()
+    return session.submit(session.client.call(queue_name, method, *args, **kwargs))
+
+
+def call_wait_async(queue_name, method, *args, **kwargs) -> Future:
+    session = get_session()
+    return session.submit(session.client.call_wait(queue_name, method, *args, **kwargs))
 
 
 def call(queue_name, method, *args, **kwargs):
-    loop, client = _create_session()
-    try:
-        loop.run_until_complete(client.start())
-        coroutine = client.call(queue_name, method, *args, **kwargs)
-        loop.run_until_complete(coroutine)
-    finally:
-        _destroy_session(client)
+    call_async(queue_name, method, *args, **kwargs).result()
 
 
 def call_wait(queue_name, method, *args, **kwargs):
-    loop, client = _create_session()
-    try:
-        loop.run_until_complete(client.start())
-        coroutine = client.call_wait(queue_name, method, *args, **kwargs)
-        return loop.run_until_complete(coroutine)
-    finally:
-        _destroy_session(client)
+    return call_wait_async(queue_name, method, *args, **kwargs).result()
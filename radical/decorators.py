@@ -1,3 +1,12 @@
-def method(fn):
-    fn.__radical__ = True
+EXECUTORS = ('loop', 'thread', 'process')
+
+
+def method(fn=None, **options):
+    # Supports both `@method` and `@method(executor='thread')` forms.
+    if fn is None:
+        return lambda fn: method(fn, **options)
+    executor = options.get('executor')
+    assert executor is None or executor in EXECUTORS, \
+        f'Unknown executor {executor}, expected one of {EXECUTORS}.'
+    fn.__radical__ = options
     return fn
@@ -0,0 +1,12 @@
+from collections import namedtuple
+
+
+# Passed to hooks registered with Peer.add_hook() at the start & end of every
+# stage of a request's lifecycle. `timestamp` is time.monotonic().
+#
+# Worker stages: accept, decode_request, call, encode_response, reply_to.
+# Client stages: encode_request, send_to, wait_response, decode_response.
+HookEvent = namedtuple('HookEvent', ('stage', 'phase', 'timestamp', 'request', 'trace'))
+
+START = 'start'
+END = 'end'
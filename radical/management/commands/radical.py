@@ -2,20 +2,44 @@ import asyncio
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connections
 
 from radical.worker import Worker
+from radical.supervisor import Supervisor, parse_processes
 
 
 class Command(BaseCommand):
     def handle(self, *args, **kwargs):
-        self.worker = Worker(
+        processes = parse_processes(settings.RADICAL_CONFIG.get('PROCESSES', 1))
+        # Workers with MAX_REQUESTS exit after that many requests and need the supervisor to be replaced.
+        if processes == 1 and not settings.RADICAL_CONFIG.get('MAX_REQUESTS'):
+            self.create_worker().run_until_complete()
+        else:
+            # Connections must not be shared by forked workers.
+            connections.close_all()
+            Supervisor(self.create_worker, processes, preload=settings.RADICAL_CONFIG['MODULES']).run()
+
+    def create_worker(self, index=0):
+        metrics_port = settings.RADICAL_CONFIG.get('METRICS_PORT')
+        if metrics_port and index:
+            metrics_port += index
+        worker = Worker(
             settings.RADICAL_CONFIG['TRANSPORT_URL'],
             queue_name=settings.RADICAL_CONFIG.get('QUEUE_NAME'),
             transport=settings.RADICAL_CONFIG.get('TRANSPORT'),
             serializer=settings.RADICAL_CONFIG.get('SERIALIZER'),
-            loop=asyncio.get_event_loop()
+            loop=asyncio.get_event_loop(),
+            concurrency=settings.RADICAL_CONFIG.get('CONCURRENCY', 100),
+            batch_size=settings.RADICAL_CONFIG.get('BATCH_SIZE', 10),
+            executor=settings.RADICAL_CONFIG.get('EXECUTOR'),
+            thread_pool_size=settings.RADICAL_CONFIG.get('THREAD_POOL_SIZE'),
+            process_pool_size=settings.RADICAL_CONFIG.get('PROCESS_POOL_SIZE'),
+            metrics_port=metrics_port,
+            metrics_host=settings.RADICAL_CONFIG.get('METRICS_HOST', '127.0.0.1'),
+            profile_rate=settings.RADICAL_CONFIG.get('PROFILE_RATE', 0),
+            max_requests=settings.RADICAL_CONFIG.get('MAX_REQUESTS', 0)
         )
-        self.worker.discover(settings.RADICAL_CONFIG['MODULES'])
-        for key, value in self.worker.methods.items():
+        worker.discover(settings.RADICAL_CONFIG['MODULES'])
+        for key, value in worker.methods.items():
             print(f'  - {key} -> {value}')
-        self.worker.run_until_complete()
+        return worker
@@ -0,0 +1,173 @@
+import asyncio
+from bisect import bisect_left
+from typing import List, Tuple
+
+from radical.log import logger
+
+DEFAULT_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf')
+)
+
+
+def _format_labels(names: Tuple[str], values: Tuple, extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # Per-bucket (not cumulative) counts & sum, cumulated on render.
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * len(self.buckets), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+WORKER_REQUESTS = REGISTRY.register(Counter(
+    'radical_worker_requests_total', 'Requests processed by worker.', ('method',)
+))
+WORKER_ERRORS = REGISTRY.register(Counter(
+    'radical_worker_errors_total', 'Requests that failed with an error.', ('method',)
+))
+WORKER_DURATION = REGISTRY.register(Histogram(
+    'radical_worker_duration_seconds', 'Method execution time.', ('method',)
+))
+WORKER_EXPIRED = REGISTRY.register(Counter(
+    'radical_worker_expired_total', 'Requests dropped because their deadline had passed.', ('method',)
+))
+WORKER_CANCELLED = REGISTRY.register(Counter(
+    'radical_worker_cancelled_total', 'Requests cancelled by their caller.', ('method',)
+))
+WORKER_QUEUE_WAIT = REGISTRY.register(Histogram(
+    'radical_worker_queue_wait_seconds', 'Time between sending a request and its dequeue.', ('method',)
+))
+WORKER_IN_FLIGHT = REGISTRY.register(Gauge(
+    'radical_worker_in_flight', 'Requests being processed right now.'
+))
+SERIALIZATION = REGISTRY.register(Histogram(
+    'radical_serialization_seconds', 'Time spent in serializer.', ('operation',)
+))
+CLIENT_CALLS = REGISTRY.register(Counter(
+    'radical_client_calls_total', 'Calls made by client.', ('method',)
+))
+CLIENT_ERRORS = REGISTRY.register(Counter(
+    'radical_client_errors_total', 'Calls that failed with an error or timeout.', ('method',)
+))
+CLIENT_REPLY = REGISTRY.register(Histogram(
+    'radical_client_reply_seconds', 'Time between sending a request and receiving its response.', ('method',)
+))
+
+
+async def _handle_http(reader, writer, registry: Registry):
+    try:
+        # Any request gets the metrics, so only the headers need to be consumed.
+        while (await reader.readline()).strip():
+            pass
+        body = registry.render().encode('utf-8')
+        writer.write(
+            b'HTTP/1.0 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body
+        )
+        await writer.drain()
+    except Exception as error:  # pragma: no cover
+        logger.error(f'Failed to serve metrics: {error!r}')
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY):
+    # Minimal HTTP server exposing metrics in Prometheus text format.
+    return await asyncio.start_server(
+        lambda reader, writer: _handle_http(reader, writer, registry), host, port
+    )
@@ -1,6 +1,12 @@
 import asyncio
 import importlib
+from time import perf_counter, monotonic
+from typing import Callable, NoReturn
 
+from radical import metrics
+from radical.hooks import HookEvent
+from radical.log import logger
+from radical.serialization import create_serializer
 from radical.serialization.base import (
     RadicalRequest, RadicalResponse, ProtocolError, BaseSerializer
 )
@@ -28,6 +34,7 @@ class Peer(object):
         self.transport = self._create_transport(transport, transport_url, queue_name)
         self.serializer = self._create_serializer(serializer)
         self.queue_name = queue_name
+        self.hooks = []
 
     def _create_transport(self, transport: str, transport_url: str, queue_name: str):
         module_name, _, class_name = transport.rpartition(':')
@@ -36,8 +43,31 @@ class Peer(object):
         return transport_class(transport_url, queue_name, self.loop)
 
     def _create_serializer(self, serializer: str) -> BaseSerializer:
-        module_name, _, class_name = serializer.rpartition(':')
-        serializer_module = importlib.import_module(module_name)
-        serializer_class = getattr(serializer_module, class_name)
-        return serializer_class()
+        return create_serializer(serializer)
 
+
+    def _serialize(self, operation: str, value):
+        # Calls serializer's `operation` (e.g. 'encode_request') and records its duration.
+        started = perf_counter()
+        try:
+            return getattr(self.serializer, operation)(value)
+        finally:
+            metrics.SERIALIZATION.observe(perf_counter() - started, operation)
+
+    def add_hook(self, hook: Callable[[HookEvent], None]) -> NoReturn:
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[HookEvent], None]) -> NoReturn:
+        self.hooks.remove(hook)
+
+    def _fire(self, stage: str, phase: str, radical_request: RadicalRequest = None, trace: dict = None):
+        if not self.hooks:
+            return
+        if trace is None and radical_request is not None:
+            trace = (radical_request.headers or {}).get('trace')
+        event = HookEvent(stage, phase, monotonic(), radical_request, trace)
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as error:
+                logger.error(f'Hook {hook} failed: {error!r}')
@@ -0,0 +1,31 @@
+import importlib
+from urllib.parse import parse_qsl
+
+from radical.serialization.base import BaseSerializer
+
+
+def create_serializer(serializer: str) -> BaseSerializer:
+    # Format: `module:Class[?option=value&...]`, e.g.
+    # `radical.serialization.pickle:PickleSerializer?compress=zlib&min=4096`
+    serializer, _, query = serializer.partition('?')
+    options = dict(parse_qsl(query))
+    module_name, _, class_name = serializer.rpartition(':')
+    serializer_module = importlib.import_module(module_name)
+    serializer_class = getattr(serializer_module, class_name)
+    instance = serializer_class()
+    if options.get('compress'):
+        from radical.serialization.compression import CompressingSerializer
+        instance = CompressingSerializer(
+            instance,
+            codec=options['compress'],
+            min_size=int(options.get('min', 4096)),
+            level=int(options['level']) if 'level' in options else None
+        )
+    if options.get('offload'):
+        from radical.serialization.offload import OffloadingSerializer, DirectoryStore
+        instance = OffloadingSerializer(
+            instance,
+            DirectoryStore(options['offload'], ttl=int(options.get('offload_ttl', 3600))),
+            min_size=int(options.get('offload_min', 1 << 20))
+        )
+    return instance
@@ -5,26 +5,35 @@ class ProtocolError(Exception):
     pass
 
 
-RadicalRequest = namedtuple('RadicalRequest', ('signature', 'reply_to'))
+RadicalRequest = namedtuple('RadicalRequest', ('signature', 'reply_to', 'headers'))
+RadicalRequest.__new__.__defaults__ = (None,)
 Signature = namedtuple('Signature', ('method', 'args', 'kwargs'))
-RadicalResponse = namedtuple('RadicalResponse', ('request', 'result', 'error'))
+# Streamed results are sent as several responses numbered by `sequence`,
+# the last one has `final` set.
+RadicalResponse = namedtuple('RadicalResponse', ('request', 'result', 'error', 'sequence', 'final'))
+RadicalResponse.__new__.__defaults__ = (None, True)
 NoRequest = namedtuple('NoRequest', ())
 
 
 class BaseSerializer(object):
     def encode_request(self, request: RadicalRequest) -> dict:
-        return dict(
+        data = dict(
             method=request.signature.method,
             args=request.signature.args,
             kwargs=request.signature.kwargs,
             reply_to=request.reply_to
         )
+        if request.headers:
+            data['headers'] = request.headers
+        return data
 
     def decode_response(self, data: dict) -> RadicalResponse:
         return RadicalResponse(
             request=None,
             result=data.get('result'),
-            error=data.get('error')
+            error=data.get('error'),
+            sequence=data.get('sequence'),
+            final=data.get('final', True)
         )
 
     def decode_request(self, data: dict) -> RadicalRequest:
@@ -36,17 +45,24 @@ class BaseSerializer(object):
             raise ProtocolError('".args" is missing or invalid.')
         if not isinstance(data.get('kwargs', {}), dict):  # pragma: no cover
             raise ProtocolError('".kwargs" is missing or invalid.')
+        if not isinstance(data.get('headers', {}), dict):  # pragma: no cover
+            raise ProtocolError('".headers" is invalid.')
         return RadicalRequest(
             signature=Signature(
                 method=data.get('method'),
                 args=data.get('args', []),
                 kwargs=data.get('kwargs', {})
             ),
-            reply_to=data.get('reply_to', '')
+            reply_to=data.get('reply_to', ''),
+            headers=data.get('headers', {})
         )
 
     def encode_response(self, response: RadicalResponse) -> dict:
-        return dict(
+        data = dict(
             result=response.result,
             error=response.error
         )
+        if response.sequence is not None:
+            data['sequence'] = response.sequence
+            data['final'] = response.final
+        return data
@@ -0,0 +1,68 @@
+import bz2
+import lzma
+import zlib
+
+from radical.serialization.base import (
+    BaseSerializer, ProtocolError, RadicalRequest, RadicalResponse
+)
+
+
+# Compressed messages start with a flag byte naming the codec, so any peer
+# can decode them regardless of its own settings. Messages below the size
+# threshold are sent as is: none of the serializers can produce a message
+# starting with one of these bytes (pickle starts with 0x80, JSON with "{",
+# MessagePack with 0x9X/0xDC).
+CODECS = {
+    'zlib': (b'\x01', zlib.compress, zlib.decompress),
+    'bz2': (b'\x02', bz2.compress, bz2.decompress),
+    'lzma': (b'\x03', lzma.compress, lzma.decompress),
+}
+DECOMPRESSORS = {flag[0]: decompress for flag, _, decompress in CODECS.values()}
+
+
+class CompressingSerializer(BaseSerializer):
+    def __init__(self, serializer: BaseSerializer, codec: str = 'zlib', min_size: int = 4096, level: int = None):
+        if codec not in CODECS:
+            raise ValueError(f'Unknown codec {codec}, expected one of {sorted(CODECS)}.')
+        self.serializer = serializer
+        self.codec = codec
+        self.min_size = min_size
+        self.level = level
+        self.flag, self._compress_fn, _ = CODECS[codec]
+
+    def compress(self, data):
+        if len(data) < self.min_size:
+            return data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.level is None:
+            compressed = self._compress_fn(data)
+        elif self.codec == 'lzma':
+            # lzma's second positional argument is the container format.
+            compressed = self._compress_fn(data, preset=self.level)
+        else:
+            compressed = self._compress_fn(data, self.level)
+        if len(compressed) + 1 >= len(data):
+            # Incompressible payload: not worth the decompression on the other side.
+            return data
+        return self.flag + compressed
+
+    def decompress(self, data):
+        if not data or isinstance(data, str) or data[0] not in DECOMPRESSORS:
+            return data
+        try:
+            return DECOMPRESSORS[data[0]](memoryview(data)[1:])
+        except Exception as error:
+            raise ProtocolError(f'Decompression failed: {error}')
+
+    def encode_request(self, request: RadicalRequest) -> bytes:
+        return self.compress(self.serializer.encode_request(request))
+
+    def decode_response(self, data: bytes) -> RadicalResponse:
+        return self.serializer.decode_response(self.decompress(data))
+
+    def decode_request(self, data: bytes) -> RadicalRequest:
+        return self.serializer.decode_request(self.decompress(data))
+
+    def encode_response(self, data: RadicalResponse) -> bytes:
+        return self.compress(self.serializer.encode_response(data))
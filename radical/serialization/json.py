@@ -5,16 +5,23 @@ from radical.serialization.base import (
 )
 
 
+def _loads(data):
+    if isinstance(data, memoryview):
+        # json can't read from buffers directly.
+        data = data.tobytes()
+    return json.loads(data)
+
+
 class JSONSerializer(BaseSerializer):
     def encode_request(self, request: RadicalRequest) -> bytes:
         return json.dumps(super().encode_request(request))
 
     def decode_response(self, data: bytes) -> RadicalResponse:
-        return super().decode_response(json.loads(data))
+        return super().decode_response(_loads(data))
 
     def decode_request(self, data: bytes) -> RadicalRequest:
         try:
-            data = json.loads(data)
+            data = _loads(data)
         except Exception as error:
             raise ProtocolError(str(error))
         return super().decode_request(data)
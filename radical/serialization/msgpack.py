@@ -0,0 +1,59 @@
+import msgpack
+
+from radical.serialization.base import (
+    BaseSerializer, ProtocolError, RadicalRequest, RadicalResponse, Signature
+)
+
+
+# Envelopes are encoded positionally to avoid sending keys with every message:
+#   request:  [method, args, kwargs, reply_to(, headers)]
+#   response: [result, error(, sequence, final)]
+# bytes, bytearray & memoryview arguments are sent as msgpack `bin` as is.
+
+
+class MsgPackSerializer(BaseSerializer):
+    def encode_request(self, request: RadicalRequest) -> bytes:
+        envelope = [
+            request.signature.method,
+            request.signature.args,
+            request.signature.kwargs,
+            request.reply_to
+        ]
+        if request.headers:
+            envelope.append(request.headers)
+        return msgpack.packb(envelope, use_bin_type=True)
+
+    def decode_response(self, data: bytes) -> RadicalResponse:
+        envelope = msgpack.unpackb(data, raw=False)
+        result, error = envelope[:2]
+        sequence, final = envelope[2:4] if len(envelope) >= 4 else (None, True)
+        return RadicalResponse(request=None, result=result, error=error, sequence=sequence, final=final)
+
+    def decode_request(self, data: bytes) -> RadicalRequest:
+        try:
+            envelope = msgpack.unpackb(data, raw=False)
+        except Exception as error:
+            raise ProtocolError(str(error))
+        if not isinstance(envelope, list) or len(envelope) < 4:
+            raise ProtocolError('request is not a valid envelope.')
+        method, args, kwargs, reply_to = envelope[:4]
+        headers = envelope[4] if len(envelope) > 4 else {}
+        if not isinstance(method, str):  # pragma: no cover
+            raise ProtocolError('".method" is missing or invalid.')
+        if not isinstance(args, list):  # pragma: no cover
+            raise ProtocolError('".args" is missing or invalid.')
+        if not isinstance(kwargs, dict):  # pragma: no cover
+            raise ProtocolError('".kwargs" is missing or invalid.')
+        if not isinstance(headers, dict):  # pragma: no cover
+            raise ProtocolError('".headers" is invalid.')
+        return RadicalRequest(
+            signature=Signature(method=method, args=args, kwargs=kwargs),
+            reply_to=reply_to or '',
+            headers=headers
+        )
+
+    def encode_response(self, data: RadicalResponse) -> bytes:
+        envelope = [data.result, data.error]
+        if data.sequence is not None:
+            envelope.extend((data.sequence, data.final))
+        return msgpack.packb(envelope, use_bin_type=True)
@@ -0,0 +1,106 @@
+import os
+import re
+import mmap
+import time
+import uuid
+
+from radical.serialization.base import (
+    BaseSerializer, ProtocolError, RadicalRequest, RadicalResponse
+)
+from radical.log import logger
+
+
+# Messages above the threshold are written to a side store and replaced
+# with a reference: flag byte followed by the blob key.
+FLAG = b'\x10'
+KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class DirectoryStore(object):
+    # Stores blobs as files in a directory shared by all peers (e.g. on /dev/shm).
+    # Blobs are memory-mapped on read and removed once consumed; blobs that
+    # were never consumed are removed after `ttl` seconds.
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, path: str, ttl: int = 3600):
+        self.path = path
+        self.ttl = ttl
+        self._last_sweep = 0
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, data) -> str:
+        key = uuid.uuid4().hex
+        temp_path = os.path.join(self.path, f'.{key}')
+        with open(temp_path, 'wb') as fobj:
+            fobj.write(data)
+        # Rename is atomic: readers never see partially written blobs.
+        os.rename(temp_path, os.path.join(self.path, key))
+        self._sweep()
+        return key
+
+    def get(self, key: str) -> mmap.mmap:
+        if not KEY_RE.match(key):
+            raise ProtocolError(f'Invalid blob key: {key!r}')
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as fobj:
+                blob = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as error:
+            raise ProtocolError(f'Failed to read blob {key}: {error}')
+        # Mapping stays valid after unlink.
+        os.unlink(path)
+        return blob
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for entry in os.scandir(self.path):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.unlink(entry.path)
+            except OSError:  # pragma: no cover
+                pass
+
+
+class OffloadingSerializer(BaseSerializer):
+    def __init__(self, serializer: BaseSerializer, store, min_size: int = 1 << 20):
+        self.serializer = serializer
+        self.store = store
+        self.min_size = min_size
+
+    def offload(self, data):
+        if len(data) < self.min_size:
+            return data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        key = self.store.put(data)
+        logger.debug(f'Offloaded {len(data)} bytes to blob {key}')
+        return FLAG + key.encode()
+
+    def decode_with(self, decode, data):
+        if not data or isinstance(data, str) or data[:1] != FLAG:
+            return decode(data)
+        blob = self.store.get(bytes(data[1:]).decode())
+        try:
+            view = memoryview(blob)
+            try:
+                return decode(view)
+            finally:
+                view.release()
+        finally:
+            blob.close()
+
+    def encode_request(self, request: RadicalRequest) -> bytes:
+        return self.offload(self.serializer.encode_request(request))
+
+    def decode_response(self, data: bytes) -> RadicalResponse:
+        return self.decode_with(self.serializer.decode_response, data)
+
+    def decode_request(self, data: bytes) -> RadicalRequest:
+        return self.decode_with(self.serializer.decode_request, data)
+
+    def encode_response(self, data: RadicalResponse) -> bytes:
+        return self.offload(self.serializer.encode_response(data))
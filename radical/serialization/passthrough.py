@@ -0,0 +1,23 @@
+from radical.serialization.base import (
+    ProtocolError, BaseSerializer, RadicalRequest, RadicalResponse
+)
+
+
+class PassthroughSerializer(BaseSerializer):
+    # Passes envelopes as is, only usable with the in-process memory transport.
+    # Arguments & results are shared (not copied) between client and worker.
+
+    def encode_request(self, request: RadicalRequest) -> RadicalRequest:
+        return request
+
+    def decode_response(self, data: RadicalResponse) -> RadicalResponse:
+        return data
+
+    def decode_request(self, data: RadicalRequest) -> RadicalRequest:
+        if not isinstance(data, RadicalRequest):
+            raise ProtocolError('request is not a RadicalRequest.')
+        return data
+
+    def encode_response(self, data: RadicalResponse) -> RadicalResponse:
+        # Drops the request so that the response does not keep its arguments alive.
+        return data._replace(request=None)
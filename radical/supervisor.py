@@ -0,0 +1,93 @@
+import os
+import time
+import signal
+import asyncio
+import importlib
+from typing import Callable, NoReturn, List
+
+from radical.log import logger
+
+# Children that die sooner than this after being forked are restarted with a delay.
+RESTART_DELAY = 1
+
+
+def parse_processes(value) -> int:
+    # `auto` means one process per core.
+    if value == 'auto':
+        return os.cpu_count() or 1
+    value = int(value)
+    if value < 1:
+        raise ValueError('Number of processes must be positive.')
+    return value
+
+
+class Supervisor(object):
+    # Runs `processes` workers in forked children, restarting them when they
+    # exit (crash or `max_requests` reached) until SIGTERM/SIGINT is received.
+
+    def __init__(self, create_worker: Callable, processes: int, preload: List[str] = ()):
+        # `create_worker(index)` is called in the child, `index` is in range(processes).
+        self.create_worker = create_worker
+        self.processes = processes
+        self.preload = preload
+        self.children = {}
+        self.terminated = False
+
+    def run(self) -> NoReturn:
+        # Imported before forking so that code is shared by children (copy on write).
+        for module_name in self.preload:
+            importlib.import_module(module_name)
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+        signal.signal(signal.SIGUSR1, self._forward)
+        for index in range(self.processes):
+            self._fork(index)
+        while self.children:
+            pid, status = os.wait()
+            index, started = self.children.pop(pid, (None, None))
+            if index is None:  # pragma: no cover
+                continue
+            if os.WIFSIGNALED(status):
+                logger.error(f'Worker {index} (pid {pid}) was killed by signal {os.WTERMSIG(status)}.')
+            elif os.WEXITSTATUS(status):
+                logger.error(f'Worker {index} (pid {pid}) exited with {os.WEXITSTATUS(status)}.')
+            else:
+                logger.info(f'Worker {index} (pid {pid}) exited.')
+            if not self.terminated:
+                if time.monotonic() - started < RESTART_DELAY:
+                    time.sleep(RESTART_DELAY)
+                self._fork(index)
+        logger.info('All workers exited.')
+
+    def _fork(self, index: int) -> NoReturn:
+        pid = os.fork()
+        if pid:
+            logger.info(f'Started worker {index} (pid {pid}).')
+            self.children[pid] = (index, time.monotonic())
+            return
+        code = 0
+        try:
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
+                signal.signal(sig, signal.SIG_DFL)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self.create_worker(index).run_until_complete()
+        except BaseException:
+            logger.exception(f'Worker {index} failed.')
+            code = 1
+        finally:
+            # Never return into the supervisor's code.
+            os._exit(code)
+
+    def _terminate(self, signum, frame) -> NoReturn:
+        if not self.terminated:
+            logger.info('Stopping all workers.')
+        self.terminated = True
+        # Each worker drains its in-flight requests before exiting.
+        self._forward(signal.SIGTERM, frame)
+
+    def _forward(self, signum, frame) -> NoReturn:
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:  # pragma: no cover
+                pass
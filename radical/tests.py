@@ -1,5 +1,8 @@
+import os
 import sys
+import time
 import asyncio
+import tempfile
 import logging
 from unittest import TestCase
 
@@ -9,6 +12,11 @@ import pytest
 from radical.worker import Worker
 from radical.client import Client
 from radical.decorators import method
+from radical.cache import make_key
+from radical.transports.base import parse_queues
+from radical.serialization import create_serializer
+from radical.serialization.base import RadicalResponse
+from radical import context, metrics
 from radical.exceptions import RadicalException, TimeoutException
 
 pytestmark = pytest.mark.asyncio
@@ -16,9 +24,15 @@ pytestmark = pytest.mark.asyncio
 logging.basicConfig(format='%(asctime)s %(levelname)8s %(message)s', level=logging.DEBUG)
 
 
-def create_pair(event_loop, request_timeout=5, **kwargs):
-    worker = Worker(f'redis://redis:6379/0', 'test', loop=event_loop, **kwargs)
-    client = Client(f'redis://redis:6379/0?request_timeout={request_timeout}', 'test', loop=event_loop, **kwargs)
+def create_pair(
+        event_loop, request_timeout=5, worker_kwargs=None, client_kwargs=None,
+        url='redis://redis:6379/0', **kwargs
+):
+    worker = Worker(url, 'test', loop=event_loop, **kwargs, **(worker_kwargs or {}))
+    client = Client(
+        f'{url}?request_timeout={request_timeout}', 'test', loop=event_loop,
+        **kwargs, **(client_kwargs or {})
+    )
     worker.register_method(
         'test.add',
         lambda a, b: a + b
@@ -32,6 +46,16 @@ def create_pair(event_loop, request_timeout=5, **kwargs):
         wait
     )
 
+    def block(delay, result=42):
+        time.sleep(delay)
+        return result
+
+    worker.register_method(
+        'test.block',
+        block,
+        executor='thread'
+    )
+
     return worker, client
 
 
@@ -62,6 +86,422 @@ async def test_call_wait_async(event_loop):
     await client.stop()
 
 
+async def test_concurrency(event_loop):
+    worker, client = create_pair(event_loop, worker_kwargs=dict(concurrency=2))
+    await worker.start()
+    await client.start()
+    started = event_loop.time()
+    results = await asyncio.gather(*[
+        client.call_wait('test', 'test.wait', 0.5, result=i)
+        for i in range(4)
+    ], loop=event_loop)
+    assert results == [0, 1, 2, 3]
+    assert event_loop.time() - started >= 1
+    await worker.stop()
+    await client.stop()
+
+
+async def test_batch_size(event_loop):
+    worker, client = create_pair(event_loop, worker_kwargs=dict(concurrency=10, batch_size=5))
+    await client.start()
+    calls = asyncio.gather(*[
+        client.call_wait('test', 'test.add', i, 1)
+        for i in range(10)
+    ], loop=event_loop)
+    await asyncio.sleep(0.5)
+    await worker.start()
+    assert (await calls) == list(range(1, 11))
+    await worker.stop()
+    await client.stop()
+
+
+async def test_thread_executor(event_loop):
+    worker, client = create_pair(event_loop)
+    await worker.start()
+    await client.start()
+    block = asyncio.ensure_future(client.call_wait('test', 'test.block', 1), loop=event_loop)
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    assert not block.done(), 'Blocking method stalled the event loop.'
+    assert (await block) == 42
+    await worker.stop()
+    await client.stop()
+
+
+async def test_call_wait_shares_subscription(event_loop):
+    worker, client = create_pair(event_loop)
+    await worker.start()
+    await client.start()
+    results = await asyncio.gather(*[
+        client.call_wait('test', 'test.add', i, i)
+        for i in range(50)
+    ], loop=event_loop)
+    assert results == [i * 2 for i in range(50)]
+    assert not client.transport.waiters
+    await worker.stop()
+    await client.stop()
+
+
+async def test_call_many(event_loop):
+    worker, client = create_pair(event_loop)
+    await worker.start()
+    await client.start()
+    assert (await client.call_many('test', [('test.add', (i, i)) for i in range(10)])) is None
+    await worker.stop()
+    await client.stop()
+
+
+async def test_call_wait_many(event_loop):
+    worker, client = create_pair(event_loop)
+    await worker.start()
+    await client.start()
+    results = await client.call_wait_many('test', [
+        ('test.add', (1300, 37)),
+        ('test.wait', (0.1,), dict(result=7)),
+        ('test.add', (1, '2')),
+    ], return_exceptions=True)
+    assert results[:2] == [1337, 7]
+    assert isinstance(results[2], RadicalException)
+    await worker.stop()
+    await client.stop()
+
+
+async def test_call_stream(event_loop):
+    worker, client = create_pair(event_loop)
+
+    async def count(n):
+        for i in range(n):
+            yield i
+
+    def letters(text):
+        yield from text
+
+    worker.register_method('test.count', count)
+    # Plain generators are advanced in threads whatever the executor.
+    worker.register_method('test.letters', letters, executor='process')
+    await worker.start()
+    await client.start()
+    assert [item async for item in client.call_stream('test', 'test.count', 100)] == list(range(100))
+    assert [item async for item in client.call_stream('test', 'test.letters', 'abc')] == ['a', 'b', 'c']
+    assert (await client.call_wait('test', 'test.letters', 'ab')) == ['a', 'b']
+    assert (await client.call_wait('test', 'test.count', 3)) == [0, 1, 2]
+    assert [item async for item in client.call_stream('test', 'test.add', 1300, 37)] == [1337]
+    await worker.stop()
+    await client.stop()
+
+
+async def test_cache(event_loop):
+    worker, client = create_pair(event_loop)
+    calls = []
+
+    def lookup(key):
+        calls.append(key)
+        return key.upper()
+
+    worker.register_method('test.lookup', lookup, cache=10, cache_shared=True)
+    await worker.start()
+    await client.start()
+    await client.invalidate_cache('test', 'test.lookup')
+    for key in ('foo', 'foo', 'bar', 'foo'):
+        assert (await client.call_wait('test', 'test.lookup', key)) == key.upper()
+    assert calls == ['foo', 'bar']
+    stats = await client.call_wait('test', '_cache_stats')
+    assert stats['test.lookup']['hits'] == 2
+    await client.invalidate_cache('test', 'test.lookup', ['foo'])
+    assert (await client.call_wait('test', 'test.lookup', 'foo')) == 'FOO'
+    assert calls == ['foo', 'bar', 'foo']
+    await worker.stop()
+    await client.stop()
+
+
+async def test_cache_invalidate_all_workers(event_loop):
+    url = 'memory://invalidate'
+    transport = 'radical.transports.memory:MemoryTransport'
+    workers = [Worker(url, 'test', transport=transport, loop=event_loop) for _ in range(2)]
+    client = Client(url, transport=transport, loop=event_loop)
+    for worker in workers:
+        worker.register_method('test.lookup', str.upper, cache=True)
+        await worker.start()
+        await worker.caches['test.lookup'].set(('foo',), {}, 'STALE')
+        await worker.caches['test.lookup'].set(('bar',), {}, 'STALE')
+    await client.invalidate_cache('test', 'test.lookup', ['foo'])
+    await asyncio.sleep(0.1)
+    for worker in workers:
+        assert (await worker.caches['test.lookup'].get(('foo',), {})) == (False, None)
+        assert (await worker.caches['test.lookup'].get(('bar',), {})) == (True, 'STALE')
+    await client.invalidate_cache('test', 'test.lookup')
+    await asyncio.sleep(0.1)
+    for worker in workers:
+        assert (await worker.caches['test.lookup'].get(('bar',), {})) == (False, None)
+        await worker.stop()
+
+
+async def test_cache_key_mixed_types():
+    assert make_key('test.lookup', ({1: 'a', 'b': 2},), {}) == make_key('test.lookup', ({'b': 2, 1: 'a'},), {})
+    assert make_key('test.lookup', ({1, 'a', None},), {}) == make_key('test.lookup', ({None, 'a', 1},), {})
+
+
+async def test_coalesce(event_loop):
+    worker, client = create_pair(event_loop, client_kwargs=dict(coalesce=True))
+    calls = []
+
+    async def slow(key):
+        calls.append(key)
+        return await asyncio.sleep(0.5, result=key)
+
+    worker.register_method('test.slow', slow)
+    await worker.start()
+    await client.start()
+    results = await asyncio.gather(*[
+        client.call_wait('test', 'test.slow', i % 2)
+        for i in range(10)
+    ], loop=event_loop)
+    assert results == [i % 2 for i in range(10)]
+    assert sorted(calls) == [0, 1]
+    await worker.stop()
+    await client.stop()
+
+
+async def test_metrics(event_loop):
+    worker, client = create_pair(event_loop, worker_kwargs=dict(metrics_port=9187))
+    await worker.start()
+    await client.start()
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    reader, writer = await asyncio.open_connection('127.0.0.1', 9187, loop=event_loop)
+    writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+    response = (await reader.read()).decode()
+    writer.close()
+    assert 'radical_worker_requests_total{method="test.add"}' in response
+    assert 'radical_client_reply_seconds_count{method="test.add"}' in response
+    await worker.stop()
+    await client.stop()
+
+
+async def test_hooks(event_loop):
+    worker, client = create_pair(event_loop, worker_kwargs=dict(profile_rate=1))
+    events = []
+    worker.add_hook(events.append)
+    client.add_hook(events.append)
+    await worker.start()
+    await client.start()
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    stages = [event.stage for event in events if event.phase == 'end']
+    for stage in ('encode_request', 'send_to', 'decode_request', 'call', 'reply_to', 'wait_response'):
+        assert stage in stages
+    traces = {event.trace['trace_id'] for event in events if event.trace}
+    assert len(traces) == 1
+    assert 'test.add' in worker.profiles
+    await worker.stop()
+    await client.stop()
+
+
+async def test_memory_transport(event_loop):
+    worker, client = create_pair(
+        event_loop, url='memory://test',
+        transport='radical.transports.memory:MemoryTransport'
+    )
+    await worker.start()
+    await client.start()
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    assert (await client.call_wait_many('test', [('test.wait', (0.1,), {})] * 10)) == [42] * 10
+    await worker.stop()
+    await client.stop()
+
+
+async def test_memory_transport_passthrough(event_loop):
+    worker, client = create_pair(
+        event_loop, url='memory://test',
+        transport='radical.transports.memory:MemoryTransport',
+        serializer='radical.serialization.passthrough:PassthroughSerializer'
+    )
+    await worker.start()
+    await client.start()
+    value = object()
+    assert (await client.call_wait('test', 'test.wait', 0, value)) is value
+    await worker.stop()
+    await client.stop()
+
+
+async def test_max_requests(event_loop):
+    worker, client = create_pair(
+        event_loop, url='memory://test',
+        transport='radical.transports.memory:MemoryTransport',
+        worker_kwargs=dict(max_requests=3)
+    )
+    main = await worker.start()
+    await client.start()
+    assert (await client.call_wait_many('test', [('test.add', (1, 2), {})] * 3)) == [3] * 3
+    await asyncio.wait_for(main, 5)
+    assert worker.accepted == 3
+    await client.stop()
+
+
+async def test_priority_queues(event_loop):
+    url = 'memory://priority?priority=strict'
+    worker = Worker(
+        url, 'high:5,low:1', transport='radical.transports.memory:MemoryTransport',
+        loop=event_loop, concurrency=1
+    )
+    client = Client(url, transport='radical.transports.memory:MemoryTransport', loop=event_loop)
+    calls = []
+    worker.register_method('test.record', calls.append)
+    await client.call_many('low', [('test.record', ('low',), {})] * 3)
+    await client.call_many('high', [('test.record', ('high',), {})] * 3)
+    await worker.start()
+    while len(calls) < 6:
+        await asyncio.sleep(0.01)
+    assert calls == ['high'] * 3 + ['low'] * 3
+    await worker.stop()
+
+
+async def test_parse_queues():
+    assert parse_queues('high:5,default') == [('high', 5), ('default', 1)]
+    assert parse_queues('app:v2,app:v3:2') == [('app:v2', 1), ('app:v3', 2)]
+    with pytest.raises(ValueError, match='Invalid queue'):
+        parse_queues('high:0')
+    with pytest.raises(ValueError, match='Invalid queue'):
+        parse_queues(':5')
+
+
+async def test_scheduled_call(event_loop):
+    worker, client = create_pair(
+        event_loop, url='memory://test',
+        transport='radical.transports.memory:MemoryTransport'
+    )
+    calls = []
+    worker.register_method('test.record', lambda value: calls.append((value, time.time())))
+    await worker.start()
+    await client.start()
+    started = time.time()
+    await client.call('test', 'test.record', 'later', countdown=1)
+    await client.call('test', 'test.record', 'now', eta=started - 1)
+    while len(calls) < 2:
+        await asyncio.sleep(0.05)
+    assert [value for value, _ in calls] == ['now', 'later']
+    assert calls[1][1] - started >= 1
+    await worker.stop()
+    await client.stop()
+
+
+async def test_deadline(event_loop):
+    worker, client = create_pair(
+        event_loop, request_timeout=1, url='memory://test',
+        transport='radical.transports.memory:MemoryTransport'
+    )
+    calls = []
+
+    async def remaining():
+        calls.append(context.remaining())
+        return calls[-1]
+
+    worker.register_method('test.remaining', remaining)
+    await client.start()
+    raised = False
+    try:
+        # No worker is running yet, so the request expires in the queue.
+        await client.call_wait('test', 'test.remaining')
+    except TimeoutException:
+        raised = True
+    assert raised, 'TimeoutException was not raised.'
+    await worker.start()
+    assert 0 < (await client.call_wait('test', 'test.remaining')) <= 1
+    assert len(calls) == 1
+    assert metrics.WORKER_EXPIRED.values[('test.remaining',)] == 1
+    await worker.stop()
+    await client.stop()
+
+
+async def test_cancel(event_loop):
+    worker, client = create_pair(
+        event_loop, url='memory://test',
+        transport='radical.transports.memory:MemoryTransport',
+        worker_kwargs=dict(concurrency=1)
+    )
+    await worker.start()
+    await client.start()
+    running = asyncio.ensure_future(client.call_wait('test', 'test.wait', 10))
+    queued = asyncio.ensure_future(client.call_wait('test', 'test.wait', 10))
+    await asyncio.sleep(0.1)
+    assert len(worker.running) == 1
+    queued.cancel()
+    running.cancel()
+    await asyncio.sleep(0.1)
+    # Running request was cancelled and the queued one was dropped instead of being started.
+    assert not worker.running
+    assert not worker.cancelled
+    assert metrics.WORKER_CANCELLED.values[('test.wait',)] == 2
+    await worker.stop()
+    await client.stop()
+
+
+async def test_batching(event_loop):
+    worker, client = create_pair(event_loop)
+    batches = []
+
+    @method(batch_size=10, max_wait_ms=50)
+    def scale(values, factor):
+        batches.append(len(values))
+        return [value * factor for value, factor in zip(values, factor)]
+
+    @method(batch_size=10)
+    def broken(values):
+        return values[1:]
+
+    worker.register_method('test.scale', scale)
+    worker.register_method('test.broken', broken)
+    await worker.start()
+    await client.start()
+    results = await asyncio.gather(*[client.call_wait('test', 'test.scale', i, factor=2) for i in range(15)])
+    assert results == [i * 2 for i in range(15)]
+    assert sum(batches) == 15 and max(batches) == 10
+    # Result count mismatch fails all calls of the batch.
+    results = await client.call_wait_many('test', [('test.broken', (i,)) for i in range(3)], return_exceptions=True)
+    assert all(isinstance(result, RadicalException) for result in results)
+    await worker.stop()
+    await client.stop()
+
+
+async def test_profile_skipped_calls(event_loop):
+    worker, client = create_pair(event_loop, worker_kwargs=dict(profile_rate=1))
+    worker.register_method('test.cached', lambda value: value, cache=True)
+    await worker.start()
+    await client.start()
+    # Second call is a cache hit: nothing to profile, but it must still be answered.
+    assert (await client.call_wait('test', 'test.cached', 1)) == 1
+    assert (await client.call_wait('test', 'test.cached', 1)) == 1
+    assert 'test.cached' in worker.profiles
+    assert worker._sample_profile('test.block') is not None
+    worker._profiling = False
+    worker.method_options['test.block']['executor'] = 'process'
+    assert worker._sample_profile('test.block') is None
+    await worker.stop()
+    await client.stop()
+
+
+async def test_context_inherited(event_loop):
+    worker, client = create_pair(event_loop, client_kwargs=dict(coalesce=True))
+    events = []
+    worker.add_hook(events.append)
+
+    async def inner():
+        return context.get('deadline')
+
+    async def outer():
+        # Calls made from tasks spawned by the method continue its trace & deadline.
+        deadlines = await asyncio.gather(client.call_wait('test', 'test.inner'), client.call_wait('test', 'test.inner'))
+        return context.get('deadline'), deadlines
+
+    worker.register_method('test.inner', inner)
+    worker.register_method('test.outer', outer)
+    await worker.start()
+    await client.start()
+    deadline, deadlines = await client.call_wait('test', 'test.outer')
+    assert deadlines == [deadline, deadline]
+    traces = {event.trace['trace_id'] for event in events if event.trace}
+    assert len(traces) == 1
+    await worker.stop()
+    await client.stop()
+
+
 async def test_call_wait_error(event_loop):
     worker, client = create_pair(event_loop)
     await worker.start()
@@ -88,6 +528,59 @@ async def test_json_serializer(event_loop):
     await client.stop()
 
 
+async def test_msgpack_serializer(event_loop):
+    worker, client = create_pair(
+        event_loop,
+        serializer='radical.serialization.msgpack:MsgPackSerializer'
+    )
+    worker.register_method('test.reverse', lambda data: data[::-1])
+    await worker.start()
+    await client.start()
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    assert (await client.call_wait('test', 'test.reverse', b'\x00\x01\x02')) == b'\x02\x01\x00'
+    await worker.stop()
+    await client.stop()
+
+
+async def test_compression(event_loop):
+    worker, client = create_pair(
+        event_loop,
+        serializer='radical.serialization.pickle:PickleSerializer?compress=zlib&min=64'
+    )
+    await worker.start()
+    await client.start()
+    assert (await client.call_wait('test', 'test.add', 'x' * 1000, 'y')) == 'x' * 1000 + 'y'
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    await worker.stop()
+    await client.stop()
+
+
+async def test_compression_level(event_loop):
+    for codec in ('zlib', 'bz2', 'lzma'):
+        serializer = create_serializer(
+            f'radical.serialization.pickle:PickleSerializer?compress={codec}&min=64&level=6'
+        )
+        response = RadicalResponse(request=None, result='x' * 1000, error=None)
+        data = serializer.encode_response(response)
+        assert len(data) < 1000
+        assert serializer.decode_response(data).result == 'x' * 1000
+
+
+async def test_offload(event_loop):
+    with tempfile.TemporaryDirectory() as path:
+        worker, client = create_pair(
+            event_loop,
+            serializer=f'radical.serialization.pickle:PickleSerializer?offload={path}&offload_min=1024'
+        )
+        await worker.start()
+        await client.start()
+        assert (await client.call_wait('test', 'test.add', b'x' * 4096, b'y')) == b'x' * 4096 + b'y'
+        assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+        assert not os.listdir(path), 'Offloaded blobs were not removed.'
+        await worker.stop()
+        await client.stop()
+
+
 async def test_bad_request(event_loop):
     worker, _ = create_pair(event_loop)
     await worker.start()
@@ -113,6 +606,20 @@ async def test_bad_request_json(event_loop):
     await worker.stop()
 
 
+async def test_reply_channel_closed(event_loop):
+    worker, client = create_pair(event_loop)
+    await worker.start()
+    await client.start()
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    transport = client.transport
+    await transport.pool.punsubscribe(transport._reply_channel.name)
+    await transport._reply_reader
+    assert transport._reply_channel is None
+    assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+    await worker.stop()
+    await client.stop()
+
+
 async def test_timeout(event_loop):
     worker, client = create_pair(event_loop, request_timeout=2)
     await worker.start()
@@ -131,12 +638,22 @@ async def test_inspect(event_loop):
     await worker.start()
     await client.start()
     actual = await client.call_wait('test', '_inspect')
-    expected = ['test.add', 'test.wait', '_inspect']
+    expected = ['test.add', 'test.wait', 'test.block', '_inspect', '_cache_stats', '_cache_invalidate']
     assert set(actual) == set(expected)
     await worker.stop()
     await client.stop()
 
 
+async def test_builtins_process_executor(event_loop):
+    worker, client = create_pair(event_loop, request_timeout=2, worker_kwargs=dict(executor='process'))
+    await worker.start()
+    await client.start()
+    assert '_inspect' in (await client.call_wait('test', '_inspect'))
+    assert (await client.call_wait('test', '_cache_stats')) == {}
+    await worker.stop()
+    await client.stop()
+
+
 async def test_discovery(event_loop):
     class RadicalFakePackage(object):
         class FakeModule(object):
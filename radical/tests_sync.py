@@ -0,0 +1,70 @@
+import os
+import time
+import signal
+import asyncio
+
+from radical.worker import Worker
+from radical.supervisor import Supervisor
+from radical.tests import create_pair
+
+# Tests that manage their own event loops or processes, so they can't run
+# under the `pytest.mark.asyncio` mark of radical/tests.py.
+
+
+def test_memory_transport_loops():
+    # Each loop gets its own broker, even for the same URL.
+    for _ in range(2):
+        loop = asyncio.new_event_loop()
+        worker, client = create_pair(
+            loop, url='memory://test',
+            transport='radical.transports.memory:MemoryTransport'
+        )
+
+        async def run():
+            await worker.start()
+            await client.start()
+            assert (await client.call_wait('test', 'test.add', 1300, 37)) == 1337
+            await worker.stop()
+            await client.stop()
+
+        loop.run_until_complete(run())
+        loop.close()
+
+
+def test_supervisor():
+    def create_worker(index):
+        return Worker('memory://supervisor', 'test', transport='radical.transports.memory:MemoryTransport')
+
+    def children(pid):
+        with open(f'/proc/{pid}/task/{pid}/children') as source:
+            return set(map(int, source.read().split()))
+
+    def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return
+            time.sleep(0.1)
+        assert False, 'Timed out.'
+
+    pid = os.fork()
+    if not pid:
+        try:
+            Supervisor(create_worker, 2).run()
+        finally:
+            os._exit(0)
+    try:
+        wait_for(lambda: len(children(pid)) == 2)
+        original = children(pid)
+        killed = min(original)
+        os.kill(killed, signal.SIGKILL)
+        # Crashed worker is replaced, the other one keeps running.
+        wait_for(lambda: len(children(pid)) == 2 and killed not in children(pid))
+        assert len(children(pid) & original) == 1
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    finally:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,108 @@
+import uuid
+import random
+from typing import Awaitable, AsyncIterator, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qsl
+
+PRIORITIES = ('weighted', 'strict')
+
+
+def parse_queues(spec: str) -> List[Tuple[str, int]]:
+    # `high:5,default:1` -> [('high', 5), ('default', 1)], weight defaults to 1.
+    # Only a trailing number is a weight, so `app:v2` is a queue name.
+    queues = []
+    for item in spec.split(','):
+        name, _, weight = item.strip().rpartition(':')
+        if not weight.isdigit():
+            name, weight = item.strip(), '1'
+        weight = int(weight)
+        if not name or weight < 1:
+            raise ValueError(f'Invalid queue {item!r}, expected "name" or "name:weight".')
+        queues.append((name, weight))
+    return queues
+
+
+class BaseTransport(object):
+    def __init__(self, transport_url, queue_name, loop):
+        self.transport_url = transport_url
+        self.loop = loop
+        self.urlinfo = urlparse(transport_url)
+        self.config = dict(parse_qsl(self.urlinfo.query))
+        self.request_timeout = int(self.config.get('request_timeout', 10))
+        # A worker may consume several queues, `queue_name` is the first one.
+        self.queues = parse_queues(queue_name)
+        self.queue_name = self.queues[0][0]
+        self.priority = self.config.get('priority', 'weighted')
+        assert self.priority in PRIORITIES, \
+            f'Unknown priority {self.priority}, expected one of {PRIORITIES}.'
+
+    def queue_order(self) -> List[str]:
+        # Order in which queues are polled by get_next_requests.
+        # Strict: heaviest first, always. Weighted: each queue comes first
+        # with a probability proportional to its weight, so lanes with work
+        # get the spare capacity and none of them starves.
+        if len(self.queues) == 1:
+            return [self.queue_name]
+        if self.priority == 'strict':
+            return [name for name, _ in sorted(self.queues, key=lambda queue: -queue[1])]
+        return [
+            name for _, name in
+            sorted(((random.random() ** (1 / weight), name) for name, weight in self.queues), reverse=True)
+        ]
+
+    async def start(self):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def stop(self):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def get_next_requests(self, count=1) -> List[bytes]:  # pragma: no cover
+        raise NotImplementedError()
+
+    async def reply_to(self, request_id, message):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def send_to(self, queue_name, message):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def send_many(self, queue_name, messages):  # pragma: no cover
+        # Transports should override this to push all messages in one round trip.
+        for message in messages:
+            await self.send_to(queue_name, message)
+
+    async def send_at(self, queue_name, message, due: float):  # pragma: no cover
+        # Stores `message` until `due` (unix time), then promote_due moves it to the queue.
+        raise NotImplementedError()
+
+    async def promote_due(self, limit=1000) -> int:
+        # Moves up to `limit` due messages of own queues to the queues, returns their count.
+        # Called periodically by the worker.
+        return 0
+
+    async def send_control(self, queue_name, message: str):
+        # Broadcasts `message` to all workers consuming `queue_name`, e.g. `cancel <reply_to>`.
+        pass
+
+    async def get_control(self) -> Optional[AsyncIterator]:
+        # Control messages sent to own queues, None if the transport has no control channel.
+        return None
+
+    async def cache_get(self, namespace, key) -> Optional[bytes]:
+        # Shared result cache. Transports without one never return a hit.
+        return None
+
+    async def cache_set(self, namespace, key, value, ttl=None):
+        pass
+
+    async def cache_invalidate(self, namespace, key=None):
+        # Removes `key` or, if it's None, every key of the namespace.
+        pass
+
+    def new_request_id(self) -> str:
+        return uuid.uuid1().hex
+
+    async def get_response(self, request_id) -> Awaitable:  # pragma: no cover
+        raise NotImplementedError()
+
+    async def get_response_stream(self, request_id) -> AsyncIterator:  # pragma: no cover
+        # Like get_response, but yields every message sent to `request_id`.
+        raise NotImplementedError()
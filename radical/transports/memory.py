@@ -0,0 +1,166 @@
+from typing import Awaitable, AsyncIterator
+
+import heapq
+import asyncio
+import weakref
+from itertools import count
+from time import monotonic, time
+
+from radical.transports.base import BaseTransport
+from radical.log import logger
+from radical import exceptions
+
+
+class Broker(object):
+    # State shared by all transports with the same URL within this process.
+
+    def __init__(self):
+        self.queues = {}
+        self.waiters = {}
+        self.cache = {}
+        # Heaps of (due, sequence, message) by queue name.
+        self.scheduled = {}
+        self.sequence = count()
+        # Control message subscribers (queues) by queue name.
+        self.controls = {}
+
+    def get_queue(self, queue_name) -> asyncio.Queue:
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            queue = self.queues[queue_name] = asyncio.Queue()
+        return queue
+
+
+# Brokers by loop, then by name: queues & futures can only be used by one loop.
+BROKERS = weakref.WeakKeyDictionary()
+
+
+class MemoryTransport(BaseTransport):
+    # In-process transport: `memory://name` connects peers of this process
+    # using the same name. Messages are passed by reference, so with
+    # `radical.serialization.passthrough:PassthroughSerializer` nothing is
+    # serialized at all.
+
+    def __init__(self, transport_url, queue_name, loop):
+        super().__init__(transport_url, queue_name, loop)
+        name = self.urlinfo.netloc + self.urlinfo.path
+        brokers = BROKERS.setdefault(loop, {})
+        self.broker = brokers.get(name)
+        if self.broker is None:
+            self.broker = brokers[name] = Broker()
+
+    async def start(self):
+        logger.debug('Memory transport started')
+
+    async def stop(self):
+        pass
+
+    async def get_next_requests(self, count=1):
+        queues = [self.broker.get_queue(queue_name) for queue_name in self.queue_order()]
+        messages = []
+        if all(queue.empty() for queue in queues):
+            getters = [asyncio.ensure_future(queue.get(), loop=self.loop) for queue in queues]
+            # Same as Redis' BLPOP timeout, lets the worker notice it was stopped.
+            await asyncio.wait(getters, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+            for getter in getters:
+                if getter.done():
+                    messages.append(getter.result())
+                else:
+                    getter.cancel()
+        for queue in queues:
+            while len(messages) < count and not queue.empty():
+                messages.append(queue.get_nowait())
+        return messages
+
+    async def reply_to(self, request_id, message):
+        waiter = self.broker.waiters.get(request_id)
+        if waiter is None:
+            logger.debug('No one is waiting for %s, dropping response', request_id)
+        elif isinstance(waiter, asyncio.Queue):
+            waiter.put_nowait(message)
+        elif not waiter.done():
+            waiter.set_result(message)
+
+    async def send_to(self, queue_name, message):
+        self.broker.get_queue(queue_name).put_nowait(message)
+
+    async def send_many(self, queue_name, messages):
+        queue = self.broker.get_queue(queue_name)
+        for message in messages:
+            queue.put_nowait(message)
+
+    async def send_at(self, queue_name, message, due):
+        heapq.heappush(
+            self.broker.scheduled.setdefault(queue_name, []),
+            (due, next(self.broker.sequence), message)
+        )
+
+    async def promote_due(self, limit=1000):
+        now = time()
+        promoted = 0
+        for queue_name, _ in self.queues:
+            scheduled = self.broker.scheduled.get(queue_name)
+            queue = self.broker.get_queue(queue_name)
+            while scheduled and scheduled[0][0] <= now and promoted < limit:
+                queue.put_nowait(heapq.heappop(scheduled)[2])
+                promoted += 1
+        return promoted
+
+    async def send_control(self, queue_name, message):
+        for subscriber in self.broker.controls.get(queue_name, ()):
+            subscriber.put_nowait(message)
+
+    async def get_control(self) -> AsyncIterator:
+        subscriber = asyncio.Queue()
+        for queue_name, _ in self.queues:
+            self.broker.controls.setdefault(queue_name, []).append(subscriber)
+        async def get_messages():
+            try:
+                while True:
+                    yield await subscriber.get()
+            finally:
+                for queue_name, _ in self.queues:
+                    self.broker.controls[queue_name].remove(subscriber)
+        return get_messages()
+
+    async def cache_get(self, namespace, key):
+        value, expires = self.broker.cache.get(namespace, {}).get(key, (None, None))
+        if expires is not None and expires <= monotonic():
+            del self.broker.cache[namespace][key]
+            return None
+        return value
+
+    async def cache_set(self, namespace, key, value, ttl=None):
+        self.broker.cache.setdefault(namespace, {})[key] = (value, monotonic() + ttl if ttl else None)
+
+    async def cache_invalidate(self, namespace, key=None):
+        if key is None:
+            self.broker.cache.pop(namespace, None)
+        else:
+            self.broker.cache.get(namespace, {}).pop(key, None)
+
+    async def get_response(self, request_id) -> Awaitable:
+        future = self.loop.create_future()
+        self.broker.waiters[request_id] = future
+        async def get_message():
+            try:
+                return await asyncio.wait_for(future, self.request_timeout)
+            except asyncio.TimeoutError:
+                raise exceptions.TimeoutException('Timeout while waiting for response.')
+            finally:
+                self.broker.waiters.pop(request_id, None)
+        return get_message()
+
+    async def get_response_stream(self, request_id) -> AsyncIterator:
+        queue = asyncio.Queue()
+        self.broker.waiters[request_id] = queue
+        async def get_messages():
+            try:
+                while True:
+                    try:
+                        yield await asyncio.wait_for(queue.get(), self.request_timeout)
+                    except asyncio.TimeoutError:
+                        raise exceptions.TimeoutException('Timeout while waiting for response.')
+            finally:
+                self.broker.waiters.pop(request_id, None)
+        return get_messages()
@@ -1,113 +1,315 @@
-from typing import Awaitable
+from typing import Awaitable, AsyncIterator
 
+import time
+import uuid
+import base64
 import asyncio
-from urllib.parse import urlparse, parse_qsl
 from hashlib import md5
 from struct import unpack
 
 import aiopg
 
+from radical.transports.base import BaseTransport
 from radical.log import logger
 from radical import exceptions
 
 QUEUE_PREFIX = 'radical_'
+# Scheduled messages of all queues, indexed by due time.
+SCHEDULED_TABLE = QUEUE_PREFIX + 'scheduled'
+CONTROL_PREFIX = QUEUE_PREFIX + 'control_'
+# Max number of rows in a single multi-row INSERT.
+INSERT_CHUNK_SIZE = 1000
 
 
-class PostgresTransport(object):
+class PostgresTransport(BaseTransport):
     def __init__(self, transport_url, queue_name, loop):
-        self.transport_url = transport_url
-        self.queue_name = queue_name
-        self.loop = loop
+        super().__init__(transport_url, queue_name, loop)
         self.conn = None
-        self.lock_id = self._calculate_lock_id()
-        self.urlinfo = urlparse(transport_url)
-        config = dict(parse_qsl(self.urlinfo.query))
-        self.request_timeout = int(config.get('request_timeout', 10))
         self.closed = asyncio.Event()
 
         self.request_table = QUEUE_PREFIX + self.queue_name
+        self.request_tables = [QUEUE_PREFIX + queue_name for queue_name, _ in self.queues]
+        # All responses to this peer are sent to a single `radical_<client_id>`
+        # channel and routed to the waiting futures by request id.
+        self.client_id = uuid.uuid4().hex
+        self.reply_channel = QUEUE_PREFIX + self.client_id
+        self.waiters = {}
+        self.listener = None
+        self._listening = set()
+        self._listen_lock = None
+        self._listener_reader = None
+        self._queue_notified = None
+        self._control_channels = [CONTROL_PREFIX + queue_name for queue_name, _ in self.queues]
+        self._control_messages = None
 
-    def _calculate_lock_id(self):
-        hash_digest = md5(self.queue_name.encode('utf-8')).digest()[:8]
+    def _calculate_lock_id(self, queue_name):
+        hash_digest = md5(queue_name.encode('utf-8')).digest()[:8]
         return unpack('l', hash_digest)[0]
 
-    async def start(self):
-        self.closed.clear()
-        self.pool = await aiopg.create_pool(
+    def _connection_kwargs(self):
+        return dict(
             host=self.urlinfo.hostname,
             port=self.urlinfo.port or 5432,
             database=self.urlinfo.path[1:],
             user=self.urlinfo.username,
             password=self.urlinfo.password
         )
+
+    async def start(self):
+        self.closed.clear()
+        self.pool = await aiopg.create_pool(**self._connection_kwargs())
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
-                await self._lock(cursor)
-                await cursor.execute('SELECT COUNT(*) FROM pg_tables WHERE tablename = %s', [self.request_table])
-                count, = await cursor.fetchone()
-                if not count:
-                    logger.debug('Creating queue table.')
-                    await cursor.execute(f'CREATE TABLE {self.request_table}(id serial, data bytea)')
-                await self._unlock(cursor)
+                for queue_name, _ in self.queues:
+                    await self._create_table(cursor, queue_name)
+                await self._create_scheduled_table(cursor)
         logger.debug('Postgres transport started')
 
-    async def _lock(self, cursor):
-        await cursor.execute(f'SELECT pg_advisory_lock({self.lock_id})')
+    async def _create_table(self, cursor, queue_name):
+        table = QUEUE_PREFIX + queue_name
+        lock_id = self._calculate_lock_id(queue_name)
+        await cursor.execute(f'SELECT pg_advisory_lock({lock_id})')
+        await cursor.execute('SELECT COUNT(*) FROM pg_tables WHERE tablename = %s', [table])
+        count, = await cursor.fetchone()
+        if not count:
+            logger.debug(f'Creating queue table {table}.')
+            await cursor.execute(f'CREATE TABLE {table}(id serial PRIMARY KEY, data bytea)')
+        else:
+            # Tables created by older versions have no index: dequeuing would scan them.
+            await cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {table}_id ON {table}(id)')
+        await cursor.execute(f'SELECT pg_advisory_unlock({lock_id})')
 
-    async def _unlock(self, cursor):
-        await cursor.execute(f'SELECT pg_advisory_unlock({self.lock_id})')
+    async def _create_scheduled_table(self, cursor):
+        lock_id = self._calculate_lock_id(SCHEDULED_TABLE)
+        await cursor.execute(f'SELECT pg_advisory_lock({lock_id})')
+        # Due rows are deleted by id, which must not scan the table either.
+        await cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {SCHEDULED_TABLE}'
+            f'(id bigserial PRIMARY KEY, queue text NOT NULL, due double precision NOT NULL, data bytea)'
+        )
+        await cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {SCHEDULED_TABLE}_due ON {SCHEDULED_TABLE}(queue, due)'
+        )
+        await cursor.execute(f'SELECT pg_advisory_unlock({lock_id})')
 
     async def stop(self):
+        if self.listener is not None:
+            self._listener_reader.cancel()
+            self.listener.close()
+            self.listener = None
+            self._listening.clear()
         self.pool.close()
 
-    async def get_next_request(self):
-        result = None
+    async def _listen(self, channel_name):
+        # A single dedicated connection receives all notifications for this
+        # peer, so waiting for them never holds a pooled connection.
+        if self._listen_lock is None:
+            self._listen_lock = asyncio.Lock()
+        async with self._listen_lock:
+            if self.listener is not None and self.listener.closed:
+                self._listener_reader.cancel()
+                self._reset_listener(self.listener)
+            if self.listener is not None and channel_name in self._listening:
+                return
+            channel_names = {channel_name}
+            if self.listener is None:
+                self.listener = await aiopg.connect(**self._connection_kwargs())
+                self._listener_reader = asyncio.ensure_future(
+                    self._read_notifications(self.listener), loop=self.loop
+                )
+                # Reconnecting: channels of the lost connection are listened to again.
+                channel_names |= self._listening
+            async with self.listener.cursor() as cursor:
+                for name in sorted(channel_names):
+                    logger.debug(f'LISTEN {name}')
+                    await cursor.execute(f'LISTEN "{name}"')
+            self._listening |= channel_names
+
+    async def _read_notifications(self, listener):
+        try:
+            while True:
+                msg = await listener.notifies.get()
+                if msg.channel in self.request_tables:
+                    self._queue_notified.set()
+                elif msg.channel == self.reply_channel:
+                    self._dispatch_reply(msg.payload)
+                elif msg.channel in self._control_channels and self._control_messages is not None:
+                    self._control_messages.put_nowait(msg.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.error(f'Failed to read notifications: {error!r}')
+        finally:
+            # Connection lost: the next `_listen()` reconnects.
+            self._reset_listener(listener)
+
+    def _reset_listener(self, listener):
+        if self.listener is listener:
+            logger.warning('Notification connection lost')
+            self.listener = None
+            listener.close()
+
+    def _dispatch_reply(self, payload):
+        request_id, _, message = payload.partition(':')
+        waiter = self.waiters.get(request_id)
+        if waiter is None:
+            logger.debug('Discarding response to %s: nobody is waiting for it', request_id)
+            return
+        # NOTIFY payload is text, so binary messages are sent base64-encoded.
+        kind, message = message[:1], message[1:]
+        if kind == 'b':
+            message = base64.b64decode(message)
+        if isinstance(waiter, asyncio.Queue):
+            waiter.put_nowait(message)
+        else:
+            del self.waiters[request_id]
+            if not waiter.done():
+                waiter.set_result(message)
+
+    async def get_next_requests(self, count=1):
+        if self._queue_notified is None:
+            self._queue_notified = asyncio.Event()
+        for table in self.request_tables:
+            await self._listen(table)
+        self._queue_notified.clear()
+        messages = []
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
-                try:
-                    await self._lock(cursor)
-                    await cursor.execute(f'SELECT * FROM {self.request_table} LIMIT 1')
-                    row = await cursor.fetchone()
-                    if row:
-                        logger.debug('Received new request in queue table.')
-                        id_, data = row
-                        await cursor.execute(f'DELETE FROM {self.request_table} WHERE id = {id_}')
-                        return bytes(data)
-                finally:
-                    await self._unlock(cursor)
-        await asyncio.sleep(1)
-        return result
+                for queue_name in self.queue_order():
+                    table = QUEUE_PREFIX + queue_name
+                    # Rows locked by other workers are skipped, so workers consume in parallel.
+                    await cursor.execute(
+                        f'DELETE FROM {table} WHERE id IN ('
+                        f'SELECT id FROM {table} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED'
+                        f') RETURNING id, data',
+                        [count - len(messages)]
+                    )
+                    messages.extend(bytes(data) for _, data in sorted(await cursor.fetchall()))
+                    if len(messages) >= count:
+                        break
+        if messages:
+            logger.debug('Received %d new requests in queue tables.', len(messages))
+            return messages
+        try:
+            # Poll once per second anyway in case a notification was missed.
+            await asyncio.wait_for(self._queue_notified.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+        return []
 
     async def reply_to(self, request_id, message):
-        source_name = QUEUE_PREFIX + request_id
+        client_id, _, message_id = request_id.partition('.')
+        source_name = QUEUE_PREFIX + client_id
+        if isinstance(message, (bytes, bytearray, memoryview)):
+            payload = f'{message_id}:b{base64.b64encode(message).decode()}'
+        else:
+            payload = f'{message_id}:s{message}'
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
                 logger.debug(f'NOTIFY {source_name}')
-                await cursor.execute(f'NOTIFY {source_name}, %s', [message])
+                await cursor.execute('SELECT pg_notify(%s, %s)', [source_name, payload])
 
     async def send_to(self, queue_name, message):
         source_name = QUEUE_PREFIX + queue_name
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cursor:
                 logger.debug(f'Sending request to {queue_name}')
-                try:
-                    await self._lock(cursor)
-                    await cursor.execute(f'INSERT INTO {source_name}(data) VALUES(%s)', [message])
-                finally:
-                    await self._unlock(cursor)
+                await cursor.execute(f'INSERT INTO {source_name}(data) VALUES(%s)', [message])
+                await cursor.execute('SELECT pg_notify(%s, %s)', [source_name, ''])
+
+    async def send_many(self, queue_name, messages):
+        if not messages:
+            return
+        source_name = QUEUE_PREFIX + queue_name
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                logger.debug(f'Sending {len(messages)} requests to {queue_name}')
+                for offset in range(0, len(messages), INSERT_CHUNK_SIZE):
+                    chunk = messages[offset:offset + INSERT_CHUNK_SIZE]
+                    values = ', '.join(['(%s)'] * len(chunk))
+                    await cursor.execute(f'INSERT INTO {source_name}(data) VALUES {values}', chunk)
+                await cursor.execute('SELECT pg_notify(%s, %s)', [source_name, ''])
+
+    async def send_at(self, queue_name, message, due):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                logger.debug(f'Scheduling request to {queue_name}')
+                await cursor.execute(
+                    f'INSERT INTO {SCHEDULED_TABLE}(queue, due, data) VALUES(%s, %s, %s)',
+                    [queue_name, due, message]
+                )
+
+    async def promote_due(self, limit=1000):
+        now = time.time()
+        count = 0
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                for queue_name, _ in self.queues:
+                    table = QUEUE_PREFIX + queue_name
+                    # Only due rows are read through the index, however many are pending.
+                    await cursor.execute(
+                        f'WITH due AS ('
+                        f'DELETE FROM {SCHEDULED_TABLE} WHERE id IN ('
+                        f'SELECT id FROM {SCHEDULED_TABLE} WHERE queue = %s AND due <= %s '
+                        f'ORDER BY due LIMIT %s FOR UPDATE SKIP LOCKED'
+                        f') RETURNING due, data'
+                        f') INSERT INTO {table}(data) SELECT data FROM due ORDER BY due',
+                        [queue_name, now, limit - count]
+                    )
+                    if cursor.rowcount > 0:
+                        count += cursor.rowcount
+                        await cursor.execute('SELECT pg_notify(%s, %s)', [table, ''])
+                    if count >= limit:
+                        break
+        return count
+
+    async def send_control(self, queue_name, message):
+        source_name = CONTROL_PREFIX + queue_name
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                logger.debug(f'NOTIFY {source_name}')
+                await cursor.execute('SELECT pg_notify(%s, %s)', [source_name, message])
+
+    async def get_control(self) -> AsyncIterator:
+        self._control_messages = asyncio.Queue()
+        for channel_name in self._control_channels:
+            await self._listen(channel_name)
+        async def get_messages():
+            while True:
+                yield await self._control_messages.get()
+        return get_messages()
+
+    def new_request_id(self) -> str:
+        return f'{self.client_id}.{uuid.uuid1().hex}'
 
     async def get_response(self, request_id) -> Awaitable:
-        channel_name = QUEUE_PREFIX + request_id
+        await self._listen(self.reply_channel)
+        message_id = request_id.partition('.')[2]
+        future = self.loop.create_future()
+        self.waiters[message_id] = future
         async def get_message():
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cursor:
-                    logger.debug(f'Waiting for response to {request_id}')
+            logger.debug(f'Waiting for response to {request_id}')
+            try:
+                return await asyncio.wait_for(future, self.request_timeout)
+            except asyncio.TimeoutError:
+                raise exceptions.TimeoutException('Timeout while waiting for response.')
+            finally:
+                self.waiters.pop(message_id, None)
+        return get_message()
+
+    async def get_response_stream(self, request_id) -> AsyncIterator:
+        await self._listen(self.reply_channel)
+        message_id = request_id.partition('.')[2]
+        queue = asyncio.Queue()
+        self.waiters[message_id] = queue
+        async def get_messages():
+            logger.debug(f'Waiting for response stream to {request_id}')
+            try:
+                while True:
                     try:
-                        await cursor.execute(f'LISTEN {channel_name}')
-                        msg = await asyncio.wait_for(conn.notifies.get(), self.request_timeout)
-                        return msg.payload
+                        yield await asyncio.wait_for(queue.get(), self.request_timeout)
                     except asyncio.TimeoutError:
                         raise exceptions.TimeoutException('Timeout while waiting for response.')
-                    finally:
-                        await cursor.execute(f'UNLISTEN {channel_name}')
-        return get_message()
+            finally:
+                self.waiters.pop(message_id, None)
+        return get_messages()
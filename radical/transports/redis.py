@@ -1,26 +1,85 @@
-from typing import Awaitable
+from typing import Awaitable, AsyncIterator
 
+import time
+import uuid
 import asyncio
-from urllib.parse import urlparse, parse_qsl
 
 import aioredis
 from aioredis.pubsub import Receiver
-from aioredis.abc import AbcChannel
 
+from radical.transports.base import BaseTransport
 from radical.log import logger
 from radical import exceptions
 
 QUEUE_PREFIX = 'radical:'
 
+# Atomically pops up to ARGV[1] items from the heads of the lists, in order of KEYS.
+POP_MANY_SCRIPT = '''
+local items = {}
+local count = tonumber(ARGV[1])
+for _, key in ipairs(KEYS) do
+    local popped = redis.call('lrange', key, 0, count - #items - 1)
+    if #popped > 0 then
+        redis.call('ltrim', key, #popped, -1)
+        for _, item in ipairs(popped) do
+            items[#items + 1] = item
+        end
+        if #items >= count then
+            break
+        end
+    end
+end
+return items
+'''
 
-class RedisTransport(object):
+# Cache keys of a namespace include its generation, bumping the generation
+# invalidates the whole namespace without scanning for its keys.
+CACHE_GET_SCRIPT = '''
+local generation = redis.call('get', KEYS[1]) or '0'
+return redis.call('get', KEYS[1] .. ':' .. generation .. ':' .. ARGV[1])
+'''
+CACHE_SET_SCRIPT = '''
+local generation = redis.call('get', KEYS[1]) or '0'
+local key = KEYS[1] .. ':' .. generation .. ':' .. ARGV[1]
+if tonumber(ARGV[3]) > 0 then
+    return redis.call('set', key, ARGV[2], 'px', ARGV[3])
+end
+return redis.call('set', key, ARGV[2])
+'''
+CACHE_DELETE_SCRIPT = '''
+local generation = redis.call('get', KEYS[1]) or '0'
+return redis.call('del', KEYS[1] .. ':' .. generation .. ':' .. ARGV[1])
+'''
+CACHE_PREFIX = QUEUE_PREFIX + 'cache:'
+
+# Scheduled messages are kept in a sorted set by due time, members are
+# prefixed with 16 random bytes so that equal messages are not merged.
+SCHEDULED_PREFIX = QUEUE_PREFIX + 'scheduled:'
+CONTROL_PREFIX = QUEUE_PREFIX + 'control:'
+# Atomically moves up to ARGV[2] members due by ARGV[1] from KEYS[1] to the list KEYS[2].
+PROMOTE_SCRIPT = '''
+local items = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'limit', 0, tonumber(ARGV[2]))
+for _, item in ipairs(items) do
+    redis.call('lpush', KEYS[2], string.sub(item, 17))
+end
+if #items > 0 then
+    redis.call('zrem', KEYS[1], unpack(items))
+end
+return #items
+'''
+
+
+class RedisTransport(BaseTransport):
     def __init__(self, transport_url, queue_name, loop):
-        self.transport_url = transport_url
-        self.queue_name = queue_name
-        self.loop = loop
+        super().__init__(transport_url, queue_name, loop)
         self.conn = None
-        config = dict(parse_qsl(urlparse(transport_url).query))
-        self.request_timeout = int(config.get('request_timeout', 10))
+        # All responses to this peer are published to `radical:<client_id>.*`
+        # and received through a single pattern subscription.
+        self.client_id = uuid.uuid4().hex
+        self.waiters = {}
+        self._reply_channel = None
+        self._reply_reader = None
+        self._subscribe_lock = None
 
     async def start(self):
         self.pool = await aioredis.create_redis_pool(
@@ -31,23 +90,44 @@ class RedisTransport(object):
         logger.debug('Redis transport started')
 
     async def stop(self):
+        if self._reply_channel is not None:
+            await self.pool.punsubscribe(self._reply_channel.name)
+            self._reply_reader.cancel()
+            self._reply_channel = None
         self.pool.close()
         await self.pool.wait_closed()
 
-    async def get_next_request(self):
-        source_name = QUEUE_PREFIX + self.queue_name
+    async def get_next_requests(self, count=1):
+        source_names = [QUEUE_PREFIX + queue_name for queue_name in self.queue_order()]
         try:
-            result = await self.pool.execute(
-                'blpop',
-                source_name,
-                1
-            )
+            if count > 1:
+                results = await self.pool.execute(
+                    'eval',
+                    POP_MANY_SCRIPT,
+                    len(source_names),
+                    *source_names,
+                    count
+                )
+                if results:
+                    logger.debug('POP %d from %s', len(results), source_names)
+                    return results
+            # Queues are empty (or a single item is requested): block until something
+            # arrives. BLPOP pops from the first non-empty list in the given order.
+            # It runs on a connection of its own: the pool would otherwise queue other
+            # commands (e.g. streamed replies) behind it for up to a second.
+            with await self.pool as conn:
+                result = await conn.execute(
+                    'blpop',
+                    *source_names,
+                    1
+                )
             if result is not None:
-                logger.debug('BLPOP %s', source_name)
-                return result[1]
+                logger.debug('BLPOP %s', result[0])
+                return [result[1]]
         except Exception as error:
             logger.error(f'ERROR: {repr(error)}, retrying in 1 second')
             await asyncio.sleep(1)
+        return []
 
     async def reply_to(self, request_id, message):
         source_name = QUEUE_PREFIX + request_id
@@ -63,31 +143,131 @@ class RedisTransport(object):
         logger.debug('LPUSH %s', source_name)
         await self.pool.execute('lpush', source_name, message)
 
+    async def send_many(self, queue_name, messages):
+        if not messages:
+            return
+        source_name = QUEUE_PREFIX + queue_name
+        logger.debug('LPUSH %s (%d messages)', source_name, len(messages))
+        await self.pool.execute('lpush', source_name, *messages)
+
+    async def send_at(self, queue_name, message, due):
+        source_name = SCHEDULED_PREFIX + queue_name
+        logger.debug('ZADD %s', source_name)
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        await self.pool.execute('zadd', source_name, due, uuid.uuid4().bytes + bytes(message))
+
+    async def promote_due(self, limit=1000):
+        now = time.time()
+        count = 0
+        for queue_name, _ in self.queues:
+            count += await self.pool.execute(
+                'eval', PROMOTE_SCRIPT, 2,
+                SCHEDULED_PREFIX + queue_name, QUEUE_PREFIX + queue_name,
+                now, limit - count
+            )
+            if count >= limit:
+                break
+        return count
+
+    async def send_control(self, queue_name, message):
+        source_name = CONTROL_PREFIX + queue_name
+        logger.debug('PUBLISH %s', source_name)
+        await self.pool.execute('publish', source_name, message)
+
+    async def get_control(self) -> AsyncIterator:
+        # One receiver for the control channels of all consumed queues.
+        receiver = Receiver(loop=self.loop)
+        source_names = [CONTROL_PREFIX + queue_name for queue_name, _ in self.queues]
+        logger.debug('SUBSCRIBE %s', source_names)
+        await self.pool.subscribe(*[receiver.channel(source_name) for source_name in source_names])
+        async def get_messages():
+            try:
+                while await receiver.wait_message():
+                    _, message = await receiver.get()
+                    yield message.decode()
+            finally:
+                await self.pool.unsubscribe(*source_names)
+        return get_messages()
+
+    async def cache_get(self, namespace, key):
+        return await self.pool.execute('eval', CACHE_GET_SCRIPT, 1, CACHE_PREFIX + namespace, key)
+
+    async def cache_set(self, namespace, key, value, ttl=None):
+        await self.pool.execute(
+            'eval', CACHE_SET_SCRIPT, 1, CACHE_PREFIX + namespace,
+            key, value, int(ttl * 1000) if ttl else 0
+        )
+
+    async def cache_invalidate(self, namespace, key=None):
+        if key is None:
+            await self.pool.execute('incr', CACHE_PREFIX + namespace)
+        else:
+            await self.pool.execute('eval', CACHE_DELETE_SCRIPT, 1, CACHE_PREFIX + namespace, key)
+
+    def new_request_id(self) -> str:
+        return f'{self.client_id}.{uuid.uuid1().hex}'
+
+    async def _subscribe_replies(self):
+        if self._subscribe_lock is None:
+            self._subscribe_lock = asyncio.Lock()
+        async with self._subscribe_lock:
+            if self._reply_channel is not None:
+                return
+            pattern = f'{QUEUE_PREFIX}{self.client_id}.*'
+            logger.debug('PSUBSCRIBE %s', pattern)
+            self._reply_channel = (await self.pool.psubscribe(pattern))[0]
+            self._reply_reader = asyncio.ensure_future(
+                self._read_replies(self._reply_channel), loop=self.loop
+            )
+
+    async def _read_replies(self, channel):
+        try:
+            while await channel.wait_message():
+                channel_name, message = await channel.get()
+                request_id = channel_name.decode()[len(QUEUE_PREFIX):]
+                self._dispatch_reply(request_id, message)
+        finally:
+            # Channel was closed (e.g. connection lost): the next call subscribes again.
+            if self._reply_channel is channel:
+                logger.debug('Reply channel %s closed', channel.name)
+                self._reply_channel = None
+
+    def _dispatch_reply(self, request_id, message):
+        waiter = self.waiters.get(request_id)
+        if waiter is None:
+            logger.debug('Discarding response to %s: nobody is waiting for it', request_id)
+        elif isinstance(waiter, asyncio.Queue):
+            waiter.put_nowait(message)
+        else:
+            del self.waiters[request_id]
+            if not waiter.done():
+                waiter.set_result(message)
+
     async def get_response(self, request_id) -> Awaitable:
-        channel_name = QUEUE_PREFIX + request_id
-        logger.debug('SUBSCRIBE %s', channel_name)
-        channel = (await self.pool.subscribe(channel_name))[0]
+        await self._subscribe_replies()
+        future = self.loop.create_future()
+        self.waiters[request_id] = future
         async def get_message():
-            wait_coro = asyncio.ensure_future(channel.wait_message())
-            timeout_coro = asyncio.ensure_future(asyncio.sleep(self.request_timeout))
-            done = set()
             try:
-                done, running = await asyncio.wait([
-                    wait_coro, timeout_coro
-                ], return_when=asyncio.FIRST_COMPLETED)
-            except Exception as error:  # pragma: no cover
-                logger.error('Error while waiting for message:', error)
-                raise exceptions.RadicalException(f'Error while waiting for message: {str(error)}')
-            else:
-                if timeout_coro in done:
-                    raise exceptions.TimeoutException('Timeout while waiting for response.')
-                message = await channel.get()
-                return message
+                return await asyncio.wait_for(future, self.request_timeout)
+            except asyncio.TimeoutError:
+                raise exceptions.TimeoutException('Timeout while waiting for response.')
             finally:
-                timeout_coro.cancel()
-                try:
-                    await self.pool.unsubscribe(channel_name)
-                except Exception as error:  # pragma: no cover
-                    raise exceptions.TransportException(str(error))
-                channel.close()
+                self.waiters.pop(request_id, None)
         return get_message()
+
+    async def get_response_stream(self, request_id) -> AsyncIterator:
+        await self._subscribe_replies()
+        queue = asyncio.Queue()
+        self.waiters[request_id] = queue
+        async def get_messages():
+            try:
+                while True:
+                    try:
+                        yield await asyncio.wait_for(queue.get(), self.request_timeout)
+                    except asyncio.TimeoutError:
+                        raise exceptions.TimeoutException('Timeout while waiting for response.')
+            finally:
+                self.waiters.pop(request_id, None)
+        return get_messages()
@@ -1,22 +1,42 @@
 import sys
 sys.path.append('.')
 
-from typing import Union, Callable, Optional, NoReturn, Awaitable, List
+import time
+import random
+import pstats
+import cProfile
+
+from collections import OrderedDict
+from typing import Union, Callable, Optional, NoReturn, Awaitable, AsyncIterator, List
 import logging
 import asyncio
+import inspect
 import importlib
 import signal
 import traceback
 import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from urllib.parse import urlparse
 
 from radical.peer import Peer
 from radical.serialization.base import (
-    RadicalRequest, RadicalResponse, NoRequest,
-    ProtocolError, BaseSerializer
+    RadicalRequest, RadicalResponse, ProtocolError, BaseSerializer
 )
+from radical.decorators import EXECUTORS
+from radical.cache import MethodCache
+from radical.batching import MethodBatcher
 from radical.log import logger
-from radical import meta
+from radical.supervisor import Supervisor, parse_processes
+from radical import context, meta, metrics
+from radical.hooks import START, END
+
+# Scheduled calls are moved to the queue in batches of this size, and
+# checked at least this often (seconds).
+PROMOTE_BATCH_SIZE = 1000
+PROMOTE_INTERVAL = 0.5
+# Number of cancelled request ids remembered to drop them if they are still queued.
+CANCELLED_SIZE = 10000
 
 
 class Worker(Peer):
@@ -26,15 +46,56 @@ class Worker(Peer):
             queue_name: str = None,
             transport: str = None,
             serializer: str = None,
-            loop=None
+            loop=None,
+            concurrency: int = None,
+            batch_size: int = None,
+            executor: str = None,
+            thread_pool_size: int = None,
+            process_pool_size: int = None,
+            metrics_port: int = None,
+            metrics_host: str = '127.0.0.1',
+            profile_rate: float = 0,
+            max_requests: int = 0
     ):
         super().__init__(transport_url, queue_name, transport, serializer, loop)
+        if executor is None:
+            executor = 'loop'
+        assert executor in EXECUTORS, \
+            f'Unknown executor {executor}, expected one of {EXECUTORS}.'
         self.methods = {
-            '_inspect': lambda: list(self.methods.keys())
+            '_inspect': lambda: list(self.methods.keys()),
+            '_cache_stats': self._cache_stats,
+            '_cache_invalidate': self._cache_invalidate,
         }
-        self.futures = []
+        # Built-ins need the worker itself, so they always run on the loop.
+        self.method_options = {name: dict(executor='loop') for name in self.methods}
+        self.caches = {}
+        self.batchers = {}
+        self.futures = set()
         self.terminated = True
+        self.concurrency = concurrency
+        self.batch_size = batch_size or 1
+        self.executor = executor
+        self.thread_pool_size = thread_pool_size
+        self.process_pool_size = process_pool_size
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self._metrics_server = None
+        # Fraction of calls to profile, can be overridden per method with @method(profile=...).
+        self.profile_rate = profile_rate
+        self.profiles = {}
+        self._profiling = False
+        # Worker exits after accepting this many requests (0 for never), see radical.supervisor.
+        self.max_requests = max_requests
+        self.accepted = 0
+        self._executors = {}
+        self._slot_freed = None
         self._main = None
+        self._mover = None
+        self._control = None
+        # Running requests by `reply_to`, so that callers can cancel them.
+        self.running = {}
+        self.cancelled = OrderedDict()
 
     def discover(self, arg: Union[list, tuple, str]) -> List[str]:
         methods = []
@@ -51,10 +112,39 @@ class Worker(Peer):
                     methods.append(cannonical_name)
         return methods
 
-    def register_method(self, cannonical_name: str, method: Callable) -> NoReturn:
+    def register_method(self, cannonical_name: str, method: Callable, **options) -> NoReturn:
         assert cannonical_name not in self.methods, \
             f'Cannonical name {cannonical_name} already registered.'
+        decorator_options = getattr(method, '__radical__', None)
+        if isinstance(decorator_options, dict):
+            options = dict(decorator_options, **options)
+        executor = options.get('executor')
+        assert executor is None or executor in EXECUTORS, \
+            f'Unknown executor {executor}, expected one of {EXECUTORS}.'
         self.methods[cannonical_name] = method
+        self.method_options[cannonical_name] = options
+        cache = options.get('cache')
+        if cache:
+            # `cache=True` caches forever, `cache=<seconds>` sets the TTL.
+            self.caches[cannonical_name] = MethodCache(
+                cannonical_name,
+                self.transport,
+                ttl=None if cache is True else cache,
+                maxsize=options.get('cache_size', 1024),
+                shared=options.get('cache_shared', False)
+            )
+        batch_size = options.get('batch_size')
+        if batch_size:
+            assert isinstance(batch_size, int) and batch_size > 0, \
+                f'Invalid batch_size {batch_size!r}, expected a positive integer.'
+            # Method receives lists of arguments, see radical.batching.
+            self.batchers[cannonical_name] = MethodBatcher(
+                cannonical_name,
+                partial(self._call_method, cannonical_name),
+                batch_size=batch_size,
+                max_wait=options.get('max_wait_ms', 10) / 1000,
+                loop=self.loop
+            )
 
     async def start(self) -> Awaitable:
         urlinfo = urlparse(self.transport_url)
@@ -74,76 +164,337 @@ class Worker(Peer):
             sys.stderr.write(f'{meta.ERROR_COLOR}  ! No methods found.\n{meta.R}')
         sys.stderr.write('\n')
 
+        # Tasks spawned by methods see the values of the request they handle.
+        context.inherit(self.loop)
         await self.transport.start()
+        if self.metrics_port:
+            self._metrics_server = await metrics.serve(self.metrics_host, self.metrics_port)
+            logger.info(f'Serving metrics on {self.metrics_host}:{self.metrics_port}')
+        self._mover = asyncio.ensure_future(self._promote_due(), loop=self.loop)
+        self._control = asyncio.ensure_future(self._read_control(), loop=self.loop)
         self._main = asyncio.ensure_future(self._run())
         return self._main
 
     async def _run(self) -> NoReturn:
         logger.info('Radical RPC server is ready.')
         self.terminated = False
-        self.futures.append(asyncio.ensure_future(self._accept(), loop=self.loop))
-        while len(self.futures):
-            done, running = await asyncio.wait(
-                self.futures,
-                return_when=asyncio.FIRST_COMPLETED,
-                loop=self.loop
-            )
-            while done:
-                future = done.pop()
-                self.futures.remove(future)
-                obj = future.result()
-                if isinstance(obj, RadicalRequest):
-                    if not self.terminated:
-                        self.futures.append(asyncio.ensure_future(self._accept(), loop=self.loop))
-                    self.futures.append(
-                        asyncio.ensure_future(self._process_request(obj), loop=self.loop)
+        # Created here so that it is bound to the running loop.
+        self._slot_freed = asyncio.Event()
+        while not self.terminated and not self._exhausted():
+            if self.concurrency and len(self.futures) >= self.concurrency:
+                # Do not dequeue anything while all slots are taken: requests
+                # stay in the queue and can be picked up by other workers.
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            for radical_request in await self._accept(self._free_slots()):
+                self.accepted += 1
+                future = self._spawn(self._handle(radical_request))
+                if radical_request.reply_to:
+                    self.running[radical_request.reply_to] = future
+                    future.add_done_callback(
+                        lambda _, reply_to=radical_request.reply_to: self.running.pop(reply_to, None)
                     )
-                elif isinstance(obj, RadicalResponse):
-                    self.futures.append(asyncio.ensure_future(self._process_response(obj), loop=self.loop))
-                elif isinstance(obj, NoRequest):
-                    if not self.terminated:
-                        self.futures.append(asyncio.ensure_future(self._accept(), loop=self.loop))
         logger.info('Radical RPC server is terminating gracefully.')
+        while self.futures:
+            await asyncio.wait(list(self.futures))
+        self._mover.cancel()
+        self._control.cancel()
+        await asyncio.gather(self._mover, self._control, return_exceptions=True)
         await self.transport.stop()
+        for pool in self._executors.values():
+            pool.shutdown(wait=False)
+        self._executors.clear()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+            self._metrics_server = None
 
-    async def _accept(self) -> RadicalRequest:
-        request = await self.transport.get_next_request()
-        if request is not None:
+    async def _promote_due(self) -> NoReturn:
+        # Moves scheduled calls that became due to the queues.
+        while True:
             try:
-                radical_request = self.serializer.decode_request(request)
+                count = await self.transport.promote_due(PROMOTE_BATCH_SIZE)
+            except asyncio.CancelledError:
+                # An Exception before Python 3.8: don't let it keep `stop()` waiting.
+                raise
+            except Exception as error:
+                logger.error(f'Failed to promote scheduled requests: {error!r}')
+                count = 0
+            if count:
+                logger.debug(f'Promoted {count} scheduled requests.')
+            if count < PROMOTE_BATCH_SIZE:
+                await asyncio.sleep(PROMOTE_INTERVAL)
+
+    async def _read_control(self) -> NoReturn:
+        messages = await self.transport.get_control()
+        if messages is None:
+            logger.debug('Transport does not support control messages.')
+            return
+        async for message in messages:
+            action, _, argument = message.partition(' ')
+            if action == 'cancel':
+                self._cancel(argument)
+            elif action == 'invalidate':
+                self._invalidate_local(*argument.split(' '))
+            else:
+                logger.warning(f'Unknown control message {message!r}')
+
+    def _invalidate_local(self, method: str, key: str = None) -> NoReturn:
+        cache = self.caches.get(method)
+        if cache is not None:
+            cache.invalidate_local(key)
+
+    def _cancel(self, reply_to: str) -> NoReturn:
+        future = self.running.get(reply_to)
+        if future is not None:
+            logger.info(f'Cancelling request {reply_to}')
+            future.cancel()
+            return
+        # Not running here: it may still be queued, or handled by another worker.
+        self.cancelled[reply_to] = True
+        while len(self.cancelled) > CANCELLED_SIZE:
+            self.cancelled.popitem(last=False)
+
+    def _spawn(self, coro) -> asyncio.Future:
+        future = asyncio.ensure_future(coro, loop=self.loop)
+        self.futures.add(future)
+        future.add_done_callback(self._on_done)
+        metrics.WORKER_IN_FLIGHT.set(len(self.futures))
+        return future
+
+    def _on_done(self, future: asyncio.Future) -> NoReturn:
+        self.futures.discard(future)
+        metrics.WORKER_IN_FLIGHT.set(len(self.futures))
+        self._slot_freed.set()
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f'Error while handling request: {future.exception()!r}')
+
+    def _exhausted(self) -> bool:
+        return bool(self.max_requests) and self.accepted >= self.max_requests
+
+    def _free_slots(self) -> int:
+        count = self.batch_size
+        if self.concurrency:
+            count = min(count, self.concurrency - len(self.futures))
+        if self.max_requests:
+            count = min(count, self.max_requests - self.accepted)
+        return count
+
+    async def _accept(self, count: int = 1) -> List[RadicalRequest]:
+        radical_requests = []
+        self._fire('accept', START)
+        requests = await self.transport.get_next_requests(count)
+        self._fire('accept', END)
+        for request in requests:
+            self._fire('decode_request', START)
+            try:
+                radical_request = self._serialize('decode_request', request)
             except ProtocolError as error:
                 logger.error(f'Deserialization failed: {error}')
-            else:
-                return radical_request
-        return NoRequest()
+                continue
+            self._fire('decode_request', END, radical_request)
+            if radical_request.reply_to and self.cancelled.pop(radical_request.reply_to, None):
+                logger.info(f'Dropping cancelled request to {radical_request.signature.method}')
+                metrics.WORKER_CANCELLED.inc(self._metric_label(radical_request.signature.method))
+                continue
+            headers = radical_request.headers or {}
+            if headers.get('deadline') and headers['deadline'] < time.time():
+                # Caller has already given up waiting, running it would only grow the backlog.
+                logger.warning(f'Dropping expired request to {radical_request.signature.method}')
+                metrics.WORKER_EXPIRED.inc(self._metric_label(radical_request.signature.method))
+                continue
+            sent_at = headers.get('sent_at')
+            if sent_at:
+                metrics.WORKER_QUEUE_WAIT.observe(
+                    max(time.time() - sent_at, 0), self._metric_label(radical_request.signature.method)
+                )
+            radical_requests.append(radical_request)
+        return radical_requests
+
+    def _metric_label(self, method: str) -> str:
+        # Method names come from the network: keep label cardinality bounded.
+        return method if method in self.methods else '<unknown>'
+
+    async def _handle(self, radical_request: RadicalRequest) -> NoReturn:
+        # Runs in its own task, so the context belongs to this request only.
+        headers = radical_request.headers or {}
+        context.set('trace', context.new_span(headers.get('trace')))
+        # Methods can check context.remaining() to cut their own work short.
+        context.set('deadline', headers.get('deadline'))
+        radical_response = await self._process_request(radical_request)
+        await self._process_response(radical_response)
 
     async def _process_request(self, radical_request: RadicalRequest) -> Optional[RadicalResponse]:
         logger.info(f'Received request {radical_request}')
-        result, error = None, None
+        result, error, sequence = None, None, None
+        signature = radical_request.signature
+        label = self._metric_label(signature.method)
+        metrics.WORKER_REQUESTS.inc(label)
+        trace = context.get('trace')
+        self._fire('call', START, radical_request, trace)
+        started = time.perf_counter()
+        profile = self._sample_profile(signature.method)
         try:
-            signature = radical_request.signature
-            method = self.methods[signature.method]
-            if asyncio.iscoroutinefunction(method):
-                result = await method(*signature.args, **signature.kwargs)
-            else:
-                result = method(*signature.args, **signature.kwargs)
+            cache = self.caches.get(signature.method)
+            found = False
+            if cache is not None:
+                found, result = await cache.get(signature.args, signature.kwargs)
+            if not found:
+                batcher = self.batchers.get(signature.method)
+                if batcher is not None and (signature.args or signature.kwargs):
+                    # Calls without arguments have nothing to stack and are made directly.
+                    result = await batcher.submit(signature.args, signature.kwargs)
+                else:
+                    result = await self._call_method(
+                        signature.method, signature.args, signature.kwargs, profile
+                    )
+                if cache is not None and not (inspect.isasyncgen(result) or inspect.isgenerator(result)):
+                    await cache.set(signature.args, signature.kwargs, result)
+            if inspect.isasyncgen(result) or inspect.isgenerator(result):
+                items = self._iterate(signature.method, result)
+                result = None
+                if radical_request.reply_to and (radical_request.headers or {}).get('stream'):
+                    sequence = 0
+                    async for item in items:
+                        await self._process_response(RadicalResponse(
+                            request=radical_request, result=item, error=None,
+                            sequence=sequence, final=False
+                        ))
+                        sequence += 1
+                else:
+                    # Caller did not ask for a stream: send everything at once.
+                    result = [item async for item in items]
+        except asyncio.CancelledError:
+            # Cancelled by the caller: nobody waits for a response. Note that
+            # methods running in a thread or process pool can't be interrupted.
+            metrics.WORKER_CANCELLED.inc(label)
+            if profile is not None:
+                self._profiling = False
+            raise
         except Exception as method_error:
             # TODO: Include traceback
             error = str(method_error)
+        metrics.WORKER_DURATION.observe(time.perf_counter() - started, label)
+        self._fire('call', END, radical_request, trace)
+        if profile is not None:
+            self._collect_profile(signature.method, profile)
         if error:
+            metrics.WORKER_ERRORS.inc(label)
             logger.error(f'WARNING: Error occured: {error}')
         return RadicalResponse(
-            request=radical_request, result=result, error=error
+            request=radical_request, result=result, error=error,
+            sequence=sequence, final=True
+        )
+
+    def _cache_stats(self) -> dict:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    async def _cache_invalidate(self, method: str, args=None, kwargs=None) -> NoReturn:
+        # Clears the shared tier: local caches of all workers are cleared by `Client.invalidate_cache`.
+        await self.caches[method].invalidate(args, kwargs)
+
+    async def _iterate(self, name: str, generator) -> AsyncIterator:
+        if inspect.isasyncgen(generator):
+            async for item in generator:
+                yield item
+            return
+        executor = self.method_options.get(name, {}).get('executor') or self.executor
+        if executor == 'loop':
+            for item in generator:
+                yield item
+            return
+        # Generators can't be sent to other processes, so they are always advanced in threads.
+        pool = self._get_executor('thread')
+        done = object()
+        while True:
+            item = await self.loop.run_in_executor(pool, next, generator, done)
+            if item is done:
+                return
+            yield item
+
+    async def _call_method(self, name: str, args, kwargs, profile: cProfile.Profile = None):
+        method = self.methods[name]
+        executor = self.method_options.get(name, {}).get('executor') or self.executor
+        # Creating a generator runs none of its code, and it couldn't be sent back from
+        # another process anyway: it is created here and advanced by _iterate.
+        if (
+                asyncio.iscoroutinefunction(method) or inspect.isasyncgenfunction(method) or
+                inspect.isgeneratorfunction(method) or executor == 'loop'
+        ):
+            if profile is not None:
+                # Everything else running on the loop meanwhile is profiled as well.
+                profile.enable()
+            try:
+                result = method(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            finally:
+                if profile is not None:
+                    profile.disable()
+        if profile is not None and executor == 'thread':
+            return await self.loop.run_in_executor(
+                self._get_executor(executor), partial(profile.runcall, method, *args, **kwargs)
+            )
+        return await self.loop.run_in_executor(
+            self._get_executor(executor), partial(method, *args, **kwargs)
         )
 
+    def _sample_profile(self, name: str) -> Optional[cProfile.Profile]:
+        options = self.method_options.get(name, {})
+        rate = options.get('profile', self.profile_rate)
+        # Only one profiler can be active at a time. Methods running in another
+        # process and batched calls (the method is not called by the request
+        # being handled) are not profiled.
+        if not rate or self._profiling or random.random() >= rate:
+            return None
+        if name in self.batchers or (options.get('executor') or self.executor) == 'process':
+            return None
+        self._profiling = True
+        return cProfile.Profile()
+
+    def _collect_profile(self, name: str, profile: cProfile.Profile) -> NoReturn:
+        self._profiling = False
+        if not profile.getstats():
+            # Method was not run, e.g. the result came from the cache.
+            return
+        if name in self.profiles:
+            self.profiles[name].add(profile)
+        else:
+            self.profiles[name] = pstats.Stats(profile)
+
+    def dump_profiles(self, stream=None, limit: int = 30) -> NoReturn:
+        stream = stream or sys.stderr
+        for name, stats in self.profiles.items():
+            stream.write(f'\n=== Profile of {name} ===\n')
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(limit)
+
+    def _get_executor(self, executor: str):
+        if executor not in self._executors:
+            if executor == 'thread':
+                pool = ThreadPoolExecutor(max_workers=self.thread_pool_size)
+            else:
+                # Process pool requires methods & their arguments to be picklable.
+                pool = ProcessPoolExecutor(max_workers=self.process_pool_size)
+            self._executors[executor] = pool
+        return self._executors[executor]
+
     async def _process_response(self, radical_response: RadicalResponse) -> NoReturn:
-        if radical_response.request.reply_to:
+        radical_request = radical_response.request
+        if radical_request.reply_to:
             logger.info(f'Sending response {radical_response}')
-            data = self.serializer.encode_response(radical_response)
+            trace = context.get('trace')
+            self._fire('encode_response', START, radical_request, trace)
+            data = self._serialize('encode_response', radical_response)
+            self._fire('encode_response', END, radical_request, trace)
+            self._fire('reply_to', START, radical_request, trace)
             await self.transport.reply_to(
-                radical_response.request.reply_to,
+                radical_request.reply_to,
                 data
             )
+            self._fire('reply_to', END, radical_request, trace)
         else:
             logger.info(f'Discarding response {radical_response}')
 
@@ -157,6 +508,7 @@ class Worker(Peer):
                 sig,
                 lambda: asyncio.ensure_future(self.stop(), loop=self.loop)
             )
+        self.loop.add_signal_handler(signal.SIGUSR1, self.dump_profiles)
         try:
             coro = self.loop.run_until_complete(self.start())
             self.loop.run_until_complete(coro)
@@ -169,6 +521,8 @@ class Worker(Peer):
         logger.info('Attempting graceful shutdown.')
         logger.info('Do NOT kill the process right now or you will lose data!')
         self.terminated = True
+        if self._slot_freed is not None:
+            self._slot_freed.set()
         logger.info('Waiting for all tasks to complete...')
         await self._main
 
@@ -176,18 +530,62 @@ class Worker(Peer):
 def main():  # pragma: no cover
     parser = argparse.ArgumentParser()
     parser.add_argument('-u', '--url', default='redis://127.0.0.1:6379/0', dest='transport_url')
-    parser.add_argument('-q', '--queue', default='default', dest='queue_name')
+    parser.add_argument(
+        '-q', '--queue', default='default', dest='queue_name',
+        help='Queue name or several weighted queues, e.g. "high:5,default:1".'
+    )
     parser.add_argument('-t', '--transport', default='radical.transports.redis:RedisTransport')
     parser.add_argument('-s', '--serializer', default='radical.serialization.pickle:PickleSerializer')
     parser.add_argument('-l', '--level', default='INFO', help='Logging level.')
+    parser.add_argument(
+        '-c', '--concurrency', default=100, type=int,
+        help='Max number of requests processed at once, 0 for unlimited.'
+    )
+    parser.add_argument(
+        '-b', '--batch-size', default=10, type=int,
+        help='Max number of requests fetched from the queue in one round trip.'
+    )
+    parser.add_argument(
+        '-e', '--executor', default='loop', choices=EXECUTORS,
+        help='Where to run non-coroutine methods by default.'
+    )
+    parser.add_argument('--thread-pool-size', default=None, type=int, help='Defaults to 5 * CPU count.')
+    parser.add_argument('--process-pool-size', default=None, type=int, help='Defaults to CPU count.')
+    parser.add_argument('--metrics-port', default=None, type=int, help='Serve Prometheus metrics on this port.')
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument(
+        '--profile-rate', default=0, type=float,
+        help='Fraction of calls to profile, stats are printed on SIGUSR1.'
+    )
+    parser.add_argument(
+        '-p', '--processes', default=1, type=parse_processes,
+        help='Number of worker processes, "auto" for one per core.'
+    )
+    parser.add_argument(
+        '--max-requests', default=0, type=int,
+        help='Restart worker process after this many requests, 0 for never.'
+    )
     parser.add_argument('module', nargs='+', help='Module with methods. Can be specified multiple times.')
     args = dict(vars(parser.parse_args()))
     modules = args.pop('module')
+    processes = args.pop('processes')
     level = getattr(logging, args.pop('level').upper())
     logging.basicConfig(level=level, format='%(asctime)s [%(levelname)-8s] (%(module)s) %(message)s')
-    worker = Worker(**args)
-    methods = worker.discover(modules)
-    worker.run_until_complete()
+
+    def create_worker(index=0):
+        kwargs = dict(args)
+        if kwargs['metrics_port'] and index:
+            # Each process serves its own metrics.
+            kwargs['metrics_port'] += index
+        worker = Worker(**kwargs)
+        worker.discover(modules)
+        return worker
+
+    # Workers with --max-requests exit after that many requests and need the supervisor to be replaced.
+    if processes == 1 and not args['max_requests']:
+        create_worker().run_until_complete()
+    else:
+        Supervisor(create_worker, processes, preload=modules).run()
 
 
 if __name__ == '__main__':  # pragma: no cover
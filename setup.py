@@ -25,10 +25,14 @@ setup(
     ],
     include_package_data=True,
     install_requires=['aioredis'],
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     zip_safe=False,
     entry_points={
         'console_scripts': [
-            'radical=radical.worker:main'
+            'radical=radical.worker:main',
+            'radical-bench=radical.bench:main',
         ]
     },
     classifiers=[